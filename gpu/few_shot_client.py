@@ -0,0 +1,76 @@
+# ************************************************************************************************************
+# Thin client of the Few-shot inference daemon (few_shot_daemon.py). Takes exactly the arguments of
+# gpu_image_processing_wrapper.py and is called instead of it by run_gpu_python_code.php (or its local
+# counterpart: run_gpu_python_code_local.php). The job is sent to the daemon, which writes the same output
+# files; its output and return code are passed on. If no daemon is running, the wrapper is run in this
+# process, as before. Only the prediction jobs (DAEMON_CODES) go to the daemon: the fine-tuning keeps running
+# in its own process, which frees the GPU memory it used once it ends.
+#
+# ************************************************************************************************************
+
+import os
+import sys
+import json
+import socket
+import argparse
+
+# ! this config is duplicated in few_shot_daemon.py
+SOCKET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp", "few_shot_daemon.sock")
+DAEMON_CODES = ["test_few_shot.py"] # target codes of the wrapper run by the daemon, see few_shot_daemon.py
+
+
+def target_code(argv):
+    """Returns the target code ("--code") of the wrapper arguments, None if there is none."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--code', type=str)
+    return parser.parse_known_args(argv)[0].code
+
+
+def send_job(argv, socket_path=SOCKET_PATH):
+    """
+    Runs a job on the daemon.
+
+    Args:
+        argv (list): The arguments of gpu_image_processing_wrapper.py.
+        socket_path (str): The path to the Unix socket of the daemon.
+
+    Returns:
+        Tuple[int, str]: The return code and the output of the job.
+
+    Raises:
+        FileNotFoundError, ConnectionRefusedError: If no daemon listens on "socket_path".
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps({"argv": argv}) + "\n").encode("utf-8"))
+
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+
+    if not reply:
+        raise RuntimeError("the Few-shot daemon closed the connection before the job finished")
+
+    reply = json.loads(reply.decode("utf-8"))
+    return reply["returncode"], reply["output"]
+
+
+def main():
+    if target_code(sys.argv[1:]) in DAEMON_CODES:
+        try:
+            returncode, output = send_job(sys.argv[1:])
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass # no daemon: the job runs here
+        else:
+            print(output, end="")
+            sys.exit(returncode)
+
+    # the training jobs (and the jobs without a daemon) run in this process
+    import gpu_image_processing_wrapper as wrapper
+    wrapper.main(sys.argv[1:])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# ************************************************************************************************************
+# Resident Few-shot inference daemon. Running gpu_image_processing_wrapper.py as a fresh process for every
+# job means starting Python, importing torch/torchvision, building the network and loading the weights before
+# the first line is scored. The daemon does this once: it keeps the recently used models loaded (LRU, see
+# few_shot_train/model_cache.py) and runs the jobs sent by few_shot_client.py over a local Unix socket, one
+# after the other, with exactly the arguments and output files of the wrapper. Only the prediction jobs are run
+# by the daemon (DAEMON_CODES in few_shot_client.py), the client runs the training jobs in their own process.
+#
+# Start it on the GPU server with the same user (and Python environment) that runs the Few-shot jobs:
+#   python few_shot_daemon.py [--socket path] [--models number_of_models_kept]
+#
+# ************************************************************************************************************
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import traceback
+import contextlib
+import socketserver
+
+import gpu_image_processing_wrapper as wrapper
+from few_shot_train.model_cache import ModelCache
+from few_shot_client import DAEMON_CODES, target_code
+
+# ! this config is duplicated in few_shot_client.py
+SOCKET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp", "few_shot_daemon.sock")
+MODEL_CACHE_SIZE = 2 # TODO: change according to your GPU, number of models kept loaded
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Runs one job: reads {"argv": [...]} (the arguments of the wrapper) and answers with
+    {"returncode": int, "output": str}, the output being what the wrapper printed. The jobs other than
+    the prediction are refused.
+    """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+
+        output = io.StringIO()
+        returncode = 0
+        start_time = time.time()
+
+        if target_code(request["argv"]) not in DAEMON_CODES:
+            output.write("the Few-shot daemon only runs {}\n".format(", ".join(DAEMON_CODES)))
+            returncode = 2
+        else:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                try:
+                    wrapper.main(request["argv"], self.server.model_cache)
+                except SystemExit as e:
+                    returncode = e.code if isinstance(e.code, int) else 1
+                except Exception:
+                    traceback.print_exc()
+                    returncode = 1
+
+        reply = {"returncode": returncode, "output": output.getvalue()}
+        self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+        print('{} Job finished in {:.1f} s (return code {}), models: {} loaded, {} reused'.format(
+            time.strftime("%Y.%m.%d-%H.%M.%S"), time.time() - start_time, returncode,
+            self.server.model_cache.misses, self.server.model_cache.hits), flush=True)
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """Serves the jobs one at a time (the wrapper changes the working dir and uses the whole GPU)."""
+
+    def __init__(self, socket_path, model_cache):
+        self.model_cache = model_cache
+
+        # a socket left behind by a previous daemon would block the bind
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+
+        super().__init__(socket_path, JobHandler)
+        os.chmod(socket_path, 0o600) # only the user of the daemon can send jobs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, help='path to the Unix socket', default=SOCKET_PATH)
+    parser.add_argument('--models', type=int, help='number of models kept loaded', default=MODEL_CACHE_SIZE)
+    args = parser.parse_args()
+
+    with DaemonServer(args.socket, ModelCache(args.models)) as server:
+        print('{} Few-shot daemon listening on {}'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), args.socket), flush=True)
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# ************************************************************************************************************
+# Accuracy/speed report of the optional inference modes of the Few-shot prediction against the default one.
+# The same lines are predicted with the same shots ("--seed") by the default prediction and by the chosen
+# "--variant" (see VARIANTS); the report gives the time, the CER, the CER difference (variant - default) and the
+# difference of the score matrices. Every mode first predicts one line untimed (warm-up: thread pools, allocator,
+# first forward passes at the line size), then the modes are timed "--repeats" times in alternating order and the
+# fastest time of each is reported, so that the mode run first does not absorb the one-time costs.
+#
+# The data folder has the layout of the validation data of the fine-tuning: "lines/<cipher>/*.jpg" and
+# "gt/<cipher>/*.txt". Paths are relative to this folder, e.g.:
+#   python benchmark.py --model_path ../user_models/borg.pth --cipher borg --data_path <validation data> --variant shared_proposals
+#
+# ************************************************************************************************************
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import few_shot_train.htr_utils as htr_utils
+from few_shot_train.test import init_model
+from few_shot_train.train import get_gt
+from few_shot_train.support_bank import SupportFeatureBank
+from few_shot_train.line_anchors import line_mode_config
+
+# extra arguments of draw_and_read of every inference mode
+VARIANTS = {
+    "shared_proposals": dict(shared_proposals=True),
+    "line_mode": dict(line_mode=True),
+    "skip_blank": dict(skip_blank=True),
+    "resize_buckets": dict(resize_buckets=(512, 1024, 2048)), # with --resize only
+    "adaptive_shots": dict(adaptive_shots=True),
+}
+
+
+def predict(model, device, args, list_lines, lines_path, support_bank, log_path, **variant):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start_time = time.time()
+    matrices = htr_utils.draw_and_read(model, device, args.alphabet_path, args.resize, args.threshold, list_lines, lines_path, args.cipher, args.shots, log_path,
+                                       support_bank, seed=args.seed, **variant)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return matrices, time.time() - start_time
+
+
+def main():
+
+    # ! change working dir to the one containing this code
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, help='path to the model weights', required=True)
+    parser.add_argument('--cipher', type=str, help='name of the alphabet', required=True)
+    parser.add_argument('--data_path', type=str, help='data: lines/<cipher>/ and gt/<cipher>/', required=True)
+    parser.add_argument('--variant', type=str, help='inference mode compared with the default one', choices=sorted(VARIANTS), required=True)
+    parser.add_argument('--alphabet_path', type=str, help='path to the alphabets', default='alphabet')
+    parser.add_argument('--resize', action='store_true', help='the model uses the new resizing')
+    parser.add_argument('--shots', type=int, help='number of shots', default=5)
+    parser.add_argument('--threshold', type=float, help='threshold of the prediction', default=0.4)
+    parser.add_argument('--lines', type=int, help='number of lines used (all if 0)', default=0)
+    parser.add_argument('--seed', type=int, help='seed of the shots', default=0)
+    parser.add_argument('--repeats', type=int, help='timed runs of every mode, the fastest is reported', default=2)
+    parser.add_argument('--cpu', action='store_true', help='run on the CPU even if a GPU is available')
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    device = torch.device('cuda') if torch.cuda.is_available() and not args.cpu else torch.device('cpu')
+
+    lines_path = os.path.join(args.data_path, 'lines/')
+    text_path = os.path.join(args.data_path, 'gt/')
+    log_path = os.path.join(args.data_path, f"benchmark_{args.variant}.log")
+
+    list_lines = sorted(os.listdir(os.path.join(lines_path, args.cipher)))
+    if args.lines > 0:
+        list_lines = list_lines[:args.lines]
+
+    model = init_model(device, args.model_path, log_path)
+    model.eval()
+
+    # the support features are computed before the timings, so that both runs only score the lines
+    support_bank = SupportFeatureBank(model, device, args.alphabet_path, args.cipher, args.resize)
+    for symbol in support_bank.alphabet.symbols:
+        for symb in support_bank.alphabet.images[symbol]:
+            support_bank.get(symbol, symb)
+
+    gt = get_gt(list_lines, text_path, args.cipher, args.alphabet_path)
+
+    report = {"lines": len(list_lines), "device": str(device), "repeats": max(1, args.repeats)}
+    runs = {"default": {}, args.variant: VARIANTS[args.variant]}
+
+    # untimed warm-up of every mode on one line
+    for variant in runs.values():
+        predict(model, device, args, list_lines[:1], lines_path, support_bank, log_path, **variant)
+
+    # the modes alternate (default first, then the variant first, ...), the fastest run of each is kept
+    # the shots are seeded, so every run of a mode gives the same matrices
+    matrices = {}
+    seconds = {name: [] for name in runs}
+    for repeat in range(max(1, args.repeats)):
+        names = list(runs) if repeat % 2 == 0 else list(runs)[::-1]
+        for name in names:
+            matrices[name], run_seconds = predict(model, device, args, list_lines, lines_path, support_bank, log_path, **runs[name])
+            seconds[name].append(run_seconds)
+
+    for name in runs:
+        predictions = htr_utils.zid_read(args.threshold, matrices[name])[0]
+        report[name] = {"cer": htr_utils.get_error_rate(gt, predictions)[0], "seconds": min(seconds[name])}
+
+    differences = [np.abs(a - b) for a, b in zip(matrices["default"], matrices[args.variant])]
+    report["matrix_difference"] = {
+        "mean": float(np.mean([d.mean() for d in differences])),
+        "max": float(max(d.max() for d in differences)),
+    }
+    report["speedup"] = report["default"]["seconds"] / report[args.variant]["seconds"]
+    # positive: the variant reads worse than the default
+    report["cer_difference"] = report[args.variant]["cer"] - report["default"]["cer"]
+
+    if args.variant == "line_mode":
+        line_sizes = [(128, 2048) if args.resize else Image.open(os.path.join(lines_path, args.cipher, t)).size[::-1] for t in list_lines]
+        config = line_mode_config(model, line_sizes, support_bank.alphabet)
+        report["anchors_per_location"] = {"default": config["anchors"], "line_mode": len(config["keep"])}
+        report["proposals_per_line"] = {"default": config["default_post_nms_top_n"], "line_mode": config["post_nms_top_n"]}
+
+    with open(log_path, "a") as file:
+        file.write('{} {} \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), json.dumps(report)))
+
+    print(json.dumps(report, indent=4))
+
+if __name__ == "__main__":
+    main()
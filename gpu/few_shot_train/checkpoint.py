@@ -0,0 +1,53 @@
+# ************************************************************************************************************
+# Loading and saving of the Few-shot model weights (.pth). The checkpoint is memory-mapped where the installed
+# PyTorch supports it (torch >= 2.1 and the zip-based file format), so that the weights are paged in while
+# they are copied into the model instead of being read into a second full copy first. Otherwise it falls back
+# to the regular torch.load. The weights are saved atomically, a reader never sees a partially written file.
+#
+# ************************************************************************************************************
+
+import os
+import time
+import torch
+
+
+def load_checkpoint(model_path):
+    """
+    Loads the state dict of a saved model on the CPU, memory-mapped if possible.
+
+    Args:
+        model_path (str): The path to the saved model weights.
+
+    Returns:
+        state_dict (dict): The model weights.
+        load_time (float): The time the loading took, in seconds.
+    """
+    start_time = time.time()
+
+    try:
+        state_dict = torch.load(model_path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        # older PyTorch (no "mmap" argument) or a checkpoint in the legacy format, which cannot be mapped
+        state_dict = torch.load(model_path, map_location='cpu')
+
+    return state_dict, time.time() - start_time
+
+
+def log_load_time(log_path, model_path, total_time, load_time):
+    """Appends the time it took to build and load a model (and to read its weights) to the log file, if any."""
+    if log_path is None:
+        return
+
+    with open(log_path, "a") as file:
+        file.write('{} Model {} loaded in {:.2f} s (reading the weights: {:.2f} s) \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), model_path, total_time, load_time))
+
+
+def save_checkpoint(state_dict, model_path):
+    """Writes the model weights to a temporary file next to "model_path", then moves it in place."""
+    tmp_path = f"{model_path}.{os.getpid()}.tmp"
+    try:
+        torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, model_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
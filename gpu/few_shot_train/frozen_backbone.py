@@ -0,0 +1,188 @@
+# ************************************************************************************************************
+# Frozen-backbone fine-tuning. Users fine-tune on a handful of corrected lines, and every epoch of the regular
+# fine-tuning pushes the same lines and alphabet images through the whole VGG16. In this mode the backbone (all
+# of it, or its first "frozen_layers" layers) is frozen: the frozen layers run once per training line and per
+# alphabet image, their feature maps are kept in memory, and every step only runs the trainable part (the
+# RPNHead, the TwoMLPHead and the FastRCNNPredictor, and the upper layers of the backbone if some are left).
+# This is cheap enough to fine-tune on the CPU.
+#
+# The cached features cannot be augmented: the lines are used as they are, and the alphabet images are drawn
+# at random among the images of their symbol without the random crops and rotations of readQuerySupport.
+#
+# ************************************************************************************************************
+
+import os
+import time
+import random
+import torch
+import torch.nn.functional as F
+from torch import nn
+from collections import OrderedDict
+from torchvision.models.detection.image_list import ImageList
+from torchvision.models.detection.transform import resize_boxes
+from torchvision.transforms import functional as Fsupp
+from few_shot_train.load_data import get_data2, ImageStore
+from few_shot_train.support_bank import AlphabetBank
+import few_shot_train.utils as utils
+
+
+class FrozenBackboneDataset(object):
+    """
+    The samples of readQuerySupport, without augmentation. A sample gives the index of its line and of its
+    alphabet image (see FrozenBackboneModel) instead of the images themselves.
+
+    Arguments:
+        Xdata (dict): The training boxes, as returned by get_data2.
+        alphabet (AlphabetBank): The images of the alphabet.
+        resizing (bool): Whether the model uses the new resizing.
+        augment (int): The number of samples per line and symbol (the number of shots).
+    """
+
+    def __init__(self, Xdata, alphabet, resizing, augment):
+        self.Xdata = Xdata
+        self.alphabet = alphabet
+        self.resizing = resizing
+
+        self.listimg = list(sorted(self.Xdata.keys()))
+        self.imgs = []
+        for i in range (len(self.listimg)):
+            for c in range (augment):
+                self.imgs.append([self.listimg[i],c])
+
+        # every line and every alphabet image of the trained symbols, decoded once
+        self.lines = sorted({self.Xdata[key]['filepath'] for key in self.listimg})
+        self.line_index = {filepath: i for i, filepath in enumerate(self.lines)}
+        store = ImageStore()
+        line_paths = [filepath if os.path.isfile(filepath) else filepath.split('.png')[0]+'.jpg' for filepath in self.lines]
+        self.line_images = [Fsupp.convert_image_dtype(store.load(path, (2048,128) if self.resizing else None), torch.float) for path in line_paths]
+        self.line_sizes = [store.sizes[path] for path in line_paths]
+
+        symbols = sorted({self.Xdata[key]['class'] for key in self.listimg})
+        self.supports = [(symbol, symb) for symbol in symbols for symb in self.alphabet.images[symbol]]
+        self.support_index = {support: i for i, support in enumerate(self.supports)}
+        self.support_images = [self.alphabet.image(symbol, symb) for symbol, symb in self.supports]
+
+    def __getitem__(self, idx):
+        img_path = self.imgs[idx][0]
+        entry = self.Xdata[img_path]
+
+        line = self.line_index[entry['filepath']]
+        support = self.support_index[(entry['class'], random.choice(self.alphabet.images[entry['class']]))]
+
+        image_size = self.line_sizes[line]
+        if self.resizing:
+            resize_factors = [2048/image_size[0], 128/image_size[1]]
+        else:
+            resize_factors = [1,1]
+
+        num_objs = len(entry['bboxes'])
+        boxes = []
+        labels = []
+        for box in entry['bboxes']:
+            boxes.append([int(box['x1'] * resize_factors[0]), int(box['y1'] * resize_factors[1]),
+                          int(box['x2'] * resize_factors[0]), int(box['y2'] * resize_factors[1])])
+            labels.append(box['class'])
+
+        boxes = torch.as_tensor(boxes, dtype=torch.float32)
+        target = {}
+        target["boxes"] = boxes
+        target["labels"] = torch.as_tensor(labels, dtype=torch.int64)
+        target["image_id"] = torch.tensor([idx])
+        target["area"] = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+        target["iscrowd"] = torch.zeros((num_objs,), dtype=torch.int64)
+
+        return torch.tensor(line), torch.tensor(support), target
+
+    def __len__(self):
+        return len(self.imgs)
+
+
+class FrozenBackboneModel(nn.Module):
+    """
+    A Few-shot model trained on cached backbone features. It has the interface of the model in training
+    mode (see train_one_epoch), but its line and support "images" are indices into the lines and the
+    alphabet images of a FrozenBackboneDataset.
+
+    Arguments:
+        model (torch.nn.Module): The Few-shot model. Its frozen layers are set to not require gradients.
+        dataset (FrozenBackboneDataset): The training lines and alphabet images.
+        device (torch.device): The device of the model.
+        frozen_layers (int, optional): The number of frozen layers at the start of the backbone (VGG16
+            features). None: the whole backbone.
+        log_path (str, optional): The log file, where the caching is reported.
+    """
+
+    def __init__(self, model, dataset, device, frozen_layers=None, log_path=None):
+        super(FrozenBackboneModel, self).__init__()
+        start_time = time.time()
+
+        self.model = model
+        if frozen_layers is None:
+            frozen_layers = len(model.backbone)
+        self.frozen = model.backbone[:frozen_layers]
+        self.trainable = model.backbone[frozen_layers:]
+        for p in self.frozen.parameters():
+            p.requires_grad_(False)
+
+        self.line_features = [self.encode(img.to(device)) for img in dataset.line_images]
+        self.support_features = [self.encode(img.to(device)) for img in dataset.support_images]
+
+        if log_path is not None:
+            with open(log_path, "a") as file:
+                file.write('{} Frozen backbone: {}/{} layers frozen, features of {} lines and {} alphabet images cached in {:.2f} s \n'.format(
+                    time.strftime("%Y.%m.%d-%H.%M.%S"), frozen_layers, len(model.backbone),
+                    len(self.line_features), len(self.support_features), time.time() - start_time))
+
+    def encode(self, image):
+        """Runs the transform and the frozen layers on an image, returns what a training step needs from them."""
+        with torch.no_grad():
+            images, _ = self.model.transform([image])
+            features = self.frozen(images.tensors)
+        return dict(features=features, padded_size=images.tensors.shape[-2:], image_size=images.image_sizes[0], original_size=image.shape[-2:])
+
+    def batch(self, encoded):
+        """Pads the cached features of several images to the same size and runs the trainable layers on them."""
+        height = max(e["features"].shape[-2] for e in encoded)
+        width = max(e["features"].shape[-1] for e in encoded)
+        features = torch.cat([
+            F.pad(e["features"], (0, width - e["features"].shape[-1], 0, height - e["features"].shape[-2]))
+            for e in encoded
+        ])
+        features = OrderedDict([(0, self.trainable(features))])
+
+        # only the shape of the padded images is used (anchors), they are not materialized
+        padded_height = max(e["padded_size"][0] for e in encoded)
+        padded_width = max(e["padded_size"][1] for e in encoded)
+        tensors = features[0].new_zeros(1, 1, 1, 1).expand(len(encoded), 3, padded_height, padded_width)
+
+        return ImageList(tensors, [e["image_size"] for e in encoded]), features
+
+    def forward(self, images, support, targets=None):
+        lines = [self.line_features[int(i)] for i in images]
+        supports = [self.support_features[int(i)] for i in support]
+
+        images, features = self.batch(lines)
+        support_images, support_features = self.batch(supports)
+        support = dict(
+            features=support_features,
+            image_sizes=support_images.image_sizes,
+            pooled=self.model.rpn.head.pool_support(support_features),
+        )
+
+        # the boxes are rescaled like the transform rescales the lines
+        if targets is not None:
+            targets = [
+                dict(target, boxes=resize_boxes(target["boxes"], line["original_size"], line["image_size"]))
+                for target, line in zip(targets, lines)
+            ]
+
+        return self.model.forward_encoded(images, features, support, [line["original_size"] for line in lines], targets)
+
+
+def load_frozen_data(batch_s, shots_number, alphabet, cipher, resizing, txtfile):
+    """The dataset and the data loader of the frozen-backbone fine-tuning, see load_data."""
+    dataset = FrozenBackboneDataset(get_data2(txtfile, False), AlphabetBank(alphabet, cipher, resizing), resizing, shots_number)
+    # the samples are indices, loading them in workers would cost more than it saves
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_s, shuffle=True, num_workers=0, collate_fn=utils.collate_fn)
+
+    return dataset, data_loader
@@ -1,12 +1,16 @@
 import torch
 from tqdm import tqdm
 from torchvision.transforms import functional as Fsupp
-import os, time
+import os, time, math
+import multiprocessing
 import numpy as np
 # from configs import getOptions
 from PIL import Image, ImageFont, ImageDraw, ImageEnhance
 import editdistance
 import random
+from few_shot_train.support_bank import SupportFeatureBank, stack_supports
+from few_shot_train.line_anchors import line_mode_config, line_mode_model
+from few_shot_train.ink_segments import ink_segments
 
 
 # options = getOptions().parse()
@@ -17,6 +21,16 @@ import random
 # threshold = options.thresh
 # device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
+MAX_SUPPORT_BATCH_SIZE = 32 # upper bound of the number of line/support pairs scored in one forward pass
+MEMORY_FRACTION_FOR_BATCHING = 0.5 # share of the available memory the support batches may use
+AVAILABLE_CPU_MEMORY_FALLBACK = 2 * 1024**3 # used if the available memory of the host cannot be read
+LINE_BATCH_SIZE = 8 # maximum number of lines encoded together
+LINE_BUCKET_WIDTH = 256 # only lines of the same height and of similar width (in steps of this many pixels) are batched together
+SHOT_TOLERANCE = 0.05 # adaptive shots: a symbol draws no more shots once a shot raises its row by at most this much
+MIN_SHOTS = 2 # adaptive shots: the number of shots of a symbol scored before the tolerance is checked
+
+_worker_job = None # set in the parent process before the line workers are forked, see score_lines_in_workers
+
 def asciitochar(a):
     string = ''
     for ch in a:
@@ -45,7 +59,381 @@ def get_error_rate(gt,pred):
         return 1,word_acc
 
 
-def drawprobs(model, device, alphabet_path, resizing, thresh, cipher, img1,shots,st_ch,en_ch):
+def max_support_batch_size(model, device, line_features, limit=MAX_SUPPORT_BATCH_SIZE):
+    """
+    Estimates how many line/support pairs can be scored in a single forward pass without running
+    out of memory. Most of the memory goes to the RoI features: every pair gets its own set of
+    proposals, each pooled from the line and from the support.
+
+    Args:
+        model (torch.nn.Module): The Few-shot model.
+        device (torch.device): The device of the model.
+        line_features (OrderedDict[Tensor]): The backbone features of the lines.
+        limit (int): Upper bound of the batch size.
+
+    Returns:
+        int: The batch size, at least 1.
+    """
+    if device.type == 'cuda':
+        available_bytes = torch.cuda.get_device_properties(device).total_memory - torch.cuda.memory_reserved(device)
+    else:
+        available_bytes = AVAILABLE_CPU_MEMORY_FALLBACK
+        try:
+            with open('/proc/meminfo') as meminfo:
+                for row in meminfo:
+                    if row.startswith('MemAvailable:'):
+                        available_bytes = int(row.split()[1]) * 1024
+                        break
+        except OSError:
+            pass
+
+    feature_map = next(iter(line_features.values()))
+    roi_size = model.roi_heads.box_roi_pool.output_size
+    roi_numel = feature_map.shape[1] * roi_size[0] * roi_size[1]
+    proposals = model.rpn.post_nms_top_n
+
+    # conditioned line features (mul, conv, relu) + line, support and merged RoI features
+    bytes_per_pair = 4 * (3 * feature_map[0].numel() + 3 * proposals * roi_numel)
+
+    return int(max(1, min(limit, available_bytes * MEMORY_FRACTION_FOR_BATCHING // bytes_per_pair)))
+
+
+def score_pairs(model, device, lines, line_features, original_line_sizes, pairs, max_batch_size=None, proposals=None):
+    """
+    Scores encoded lines against supports, several line/support pairs per forward pass. Pairs are
+    batched together if their supports have feature maps of the same shape (always the case for the
+    resizing models, where every support is 128x128).
+
+    Args:
+        model (torch.nn.Module): The Few-shot model, in eval mode.
+        device (torch.device): The device of the model.
+        lines (ImageList): The transformed lines, as returned by model.encode.
+        line_features (OrderedDict[Tensor]): The backbone features of the lines.
+        original_line_sizes (list[Tuple[int, int]]): The line sizes before the transform.
+        pairs (list[Tuple[int, dict]]): The index of the line (in lines) and the support embedding
+            (see SupportFeatureBank.get) of every pair.
+        max_batch_size (int, optional): The maximum number of pairs per forward pass.
+            Estimated from the available memory if None.
+        proposals (list[Tensor], optional): Proposals of every line shared by all its supports (see
+            model.propose). If None, the RPN runs for every pair.
+
+    Returns:
+        list[dict]: The detections (boxes, labels, scores) of every pair in the same order, in the coordinates of its line.
+    """
+    if max_batch_size is None:
+        max_batch_size = max_support_batch_size(model, device, line_features)
+
+    groups = {}
+    for i, (_, support) in enumerate(pairs):
+        groups.setdefault(tuple(support["features"][0].shape[-2:]), []).append(i)
+
+    results = [None] * len(pairs)
+    for indices in groups.values():
+        for start in range(0, len(indices), max_batch_size):
+            batch = indices[start:start+max_batch_size]
+            with torch.no_grad():
+                if proposals is None:
+                    preds = model.forward_pairs(lines, line_features, stack_supports([pairs[i][1] for i in batch]),
+                                                [pairs[i][0] for i in batch], original_line_sizes)
+                else:
+                    preds = model.forward_proposals(lines, line_features, stack_supports([pairs[i][1] for i in batch]),
+                                                    [pairs[i][0] for i in batch], original_line_sizes, proposals)
+            for i, pred in zip(batch, preds):
+                results[i] = pred
+
+    return results
+
+
+def line_chunks(lines, chunk_size):
+    """
+    Groups lines into buckets by their shape (height, and width in steps of LINE_BUCKET_WIDTH pixels)
+    and splits the buckets into chunks of at most "chunk_size" lines, which are encoded together.
+
+    Returns:
+        list[list[int]]: The indices of the lines of every chunk.
+    """
+    buckets = {}
+    for i, img in enumerate(lines):
+        buckets.setdefault((img.shape[-2], math.ceil(img.shape[-1] / LINE_BUCKET_WIDTH)), []).append(i)
+
+    return [indices[start:start+chunk_size] for indices in buckets.values() for start in range(0, len(indices), chunk_size)]
+
+
+def encode_chunk(model, device, lines, supports_per_line, shared_proposals=False):
+    """
+    Encodes a chunk of lines (see line_chunks) for score_pairs.
+
+    Returns:
+        Tuple[ImageList, OrderedDict[Tensor], list[Tuple[int, int]], list[Tensor]]: The transformed lines,
+        their backbone features, their sizes before the transform and, with "shared_proposals", their
+        proposals (None otherwise).
+    """
+    with torch.no_grad():
+        encoded_lines, line_features, _ = model.encode([img.to(device) for img in lines])
+
+    proposals = None
+    if shared_proposals:
+        prototypes = torch.cat([torch.stack([support["pooled"] for support in supports]).mean(0) for supports in supports_per_line])
+        with torch.no_grad():
+            proposals = model.propose(encoded_lines, line_features, prototypes)
+
+    return encoded_lines, line_features, [img.shape[-2:] for img in lines], proposals
+
+
+def score_lines(model, device, lines, supports_per_line, max_batch_size=None, line_batch_size=LINE_BATCH_SIZE, shared_proposals=False):
+    """
+    Scores lines against their supports, encoding several lines at once. Lines are grouped into buckets
+    by their width (every line has the same shape with the resizing models), so that the padding added
+    to batch them stays small. The detections are in the coordinates of each line.
+
+    Args:
+        model (torch.nn.Module): The Few-shot model, in eval mode.
+        device (torch.device): The device of the model.
+        lines (list[Tensor]): The line images.
+        supports_per_line (list[list[dict]]): The support embeddings each line is compared to.
+        max_batch_size (int, optional): The maximum number of line/support pairs per forward pass.
+            Estimated from the available memory if None.
+        line_batch_size (int): The maximum number of lines encoded together.
+        shared_proposals (bool): Whether the RPN runs once per line, conditioned on the mean of the
+            pooled vectors of its supports, instead of once per line/support pair. The RoI features of
+            the line are then pooled once and compared with all of its supports.
+
+    Yields:
+        Tuple[int, list[dict]]: The index of a line and its detections, one entry per support, as soon
+        as the batch of the line is done (not in the order of the lines).
+    """
+    for chunk in line_chunks(lines, line_batch_size):
+        encoded_lines, line_features, original_sizes, proposals = encode_chunk(
+            model, device, [lines[i] for i in chunk], [supports_per_line[i] for i in chunk], shared_proposals)
+
+        pairs = [(j, support) for j, i in enumerate(chunk) for support in supports_per_line[i]]
+        preds = iter(score_pairs(model, device, encoded_lines, line_features, original_sizes, pairs, max_batch_size, proposals))
+
+        for i in chunk:
+            yield i, [next(preds) for _ in supports_per_line[i]]
+
+
+def score_lines_adaptively(model, device, lines, supports_per_line, selected_symbols_per_line, thresh, symbols_number, max_batch_size=None,
+                           line_batch_size=LINE_BATCH_SIZE, shared_proposals=False, shot_tolerance=SHOT_TOLERANCE, min_shots=MIN_SHOTS):
+    """
+    Scores lines against their supports like score_lines, but the shots of every symbol are scored one
+    after the other. The matrix of a line is the maximum of the matrices of its shots (see scoreprobs),
+    so a (line, symbol) pair draws no more shots once "min_shots" of its shots are scored and the last one
+    raised no column of its row by more than "shot_tolerance". A chunk of lines is encoded once, every
+    round only runs the heads on the pairs that are still active. The proposals shared by the supports
+    of a line (with "shared_proposals") come from all of its shots, as in score_lines.
+
+    Args:
+        selected_symbols_per_line (list[list[Tuple[str, list[str]]]]): The shots of every line (see
+            AlphabetBank.select_shots), in the order of supports_per_line.
+        thresh (float): The threshold of the detection scores (see scoreprobs).
+        symbols_number (int): The number of symbols of the alphabet.
+        shot_tolerance (float): The largest change of the row of a symbol that stops its shots.
+        min_shots (int): The number of shots of a symbol scored before the tolerance is checked.
+
+    Yields:
+        Tuple[int, list[dict]]: The index of a line and its detections, one entry per support as in
+        score_lines, None for the shots that were not scored.
+    """
+    for chunk in line_chunks(lines, line_batch_size):
+        encoded_lines, line_features, original_sizes, proposals = encode_chunk(
+            model, device, [lines[i] for i in chunk], [supports_per_line[i] for i in chunk], shared_proposals)
+
+        # the indices (in supports_per_line) of the shots of every symbol of every line
+        shots = []
+        for i in chunk:
+            ends = np.cumsum([len(i_symbs) for _, i_symbs in selected_symbols_per_line[i]], dtype=int)
+            shots.append([range(end - len(i_symbs), end) for end, (_, i_symbs) in zip(ends, selected_symbols_per_line[i])])
+
+        detections = [[None] * len(supports_per_line[i]) for i in chunk]
+        matrices = [np.zeros((symbols_number, lines[i].shape[-1])) for i in chunk]
+        active = [[len(symbol_shots) > 0 for symbol_shots in line_shots] for line_shots in shots]
+
+        shot = 0
+        while any(any(line_active) for line_active in active):
+            # round "shot": the next shot of every active symbol
+            scored = [(j, p_c, shots[j][p_c][shot]) for j, line_active in enumerate(active) for p_c, is_active in enumerate(line_active) if is_active]
+            preds = score_pairs(model, device, encoded_lines, line_features, original_sizes,
+                                [(j, supports_per_line[chunk[j]][k]) for j, _, k in scored], max_batch_size, proposals)
+
+            round_detections = {}
+            for (j, _, k), pred in zip(scored, preds):
+                detections[j][k] = pred
+                round_detections.setdefault(j, [None] * len(detections[j]))[k] = pred
+
+            for j, line_detections in round_detections.items():
+                i = chunk[j]
+                matrix = scoreprobs(thresh, lines[i].shape[-1], selected_symbols_per_line[i], line_detections, 1, symbols_number)
+                changes = np.maximum(matrix - matrices[j], 0).max(axis=1)
+                np.maximum(matrices[j], matrix, out=matrices[j])
+                for p_c, is_active in enumerate(active[j]):
+                    if is_active and (shot + 1 >= len(shots[j][p_c]) or (shot + 1 >= min_shots and changes[p_c] <= shot_tolerance)):
+                        active[j][p_c] = False
+
+            shot += 1
+
+        for j, i in enumerate(chunk):
+            yield i, detections[j]
+
+
+def _init_line_worker(threads_per_worker, workers):
+    torch.set_num_threads(threads_per_worker)
+    # the memory estimate of the support batches is shared between the workers (only changes the worker's copy of this module)
+    global MEMORY_FRACTION_FOR_BATCHING
+    MEMORY_FRACTION_FOR_BATCHING = MEMORY_FRACTION_FOR_BATCHING / workers
+
+
+def _score_line_chunk(chunk):
+    job = _worker_job
+    lines = [job["lines"][i] for i in chunk]
+    supports_per_line = [job["supports_per_line"][i] for i in chunk]
+
+    if job["adaptive_shots"]:
+        scored_lines = score_lines_adaptively(job["model"], torch.device('cpu'), lines, supports_per_line,
+                                              [job["selected_symbols_per_line"][i] for i in chunk], job["thresh"], job["symbols_number"],
+                                              job["max_batch_size"], len(chunk), job["shared_proposals"], job["shot_tolerance"])
+    else:
+        scored_lines = score_lines(job["model"], torch.device('cpu'), lines, supports_per_line, job["max_batch_size"], len(chunk),
+                                   job["shared_proposals"])
+
+    results = []
+    for j, detections in scored_lines:
+        i = chunk[j]
+        results.append((i, scoreprobs(job["thresh"], lines[j].size()[2], job["selected_symbols_per_line"][i], detections, 1, job["symbols_number"]),
+                        scored_shots(detections)))
+    return results
+
+
+def score_lines_in_workers(model, lines, supports_per_line, selected_symbols_per_line, thresh, symbols_number, max_batch_size=None,
+                           line_batch_size=LINE_BATCH_SIZE, workers=2, threads_per_worker=None, shared_proposals=False,
+                           adaptive_shots=False, shot_tolerance=SHOT_TOLERANCE):
+    """
+    Scores lines on the CPU with a pool of processes. The workers are forked once the model and the
+    supports are in memory, so that they share them (copy-on-write) instead of loading them again.
+    The lines are handed out in small chunks of similar width as the workers become free.
+
+    Args:
+        model (torch.nn.Module): The Few-shot model, on the CPU and in eval mode.
+        lines (list[Tensor]): The line images.
+        supports_per_line (list[list[dict]]): The support embeddings each line is compared to.
+        selected_symbols_per_line (list[list[Tuple[str, list[str]]]]): The shots of every line (see AlphabetBank.select_shots).
+        thresh (float): The threshold of the detection scores (see scoreprobs).
+        symbols_number (int): The number of symbols of the alphabet.
+        max_batch_size (int, optional): The maximum number of line/support pairs per forward pass.
+            Estimated from the available memory (shared by the workers) if None.
+        line_batch_size (int): The maximum number of lines encoded together.
+        workers (int): The number of processes.
+        threads_per_worker (int, optional): The number of PyTorch threads of every worker.
+            None: the cores are split evenly between the workers.
+        shared_proposals (bool): Whether a line has one proposal set for all its supports (see score_lines).
+        adaptive_shots (bool): Whether the shots are scored one after the other (see score_lines_adaptively),
+            all the rounds of a chunk run in the same worker.
+        shot_tolerance (float): The tolerance of the adaptive shots.
+
+    Yields:
+        Tuple[int, np.ndarray, int]: The index of a line, its Pro_matrix and its number of scored shots,
+        as soon as its chunk is done (not in the order of the lines).
+    """
+    global _worker_job
+
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    # chunks of similar width, small enough that every worker gets some
+    chunks = line_chunks(lines, max(1, min(line_batch_size, math.ceil(len(lines) / workers))))
+
+    _worker_job = dict(model=model, lines=lines, supports_per_line=supports_per_line, selected_symbols_per_line=selected_symbols_per_line,
+                       thresh=thresh, symbols_number=symbols_number, max_batch_size=max_batch_size, shared_proposals=shared_proposals,
+                       adaptive_shots=adaptive_shots, shot_tolerance=shot_tolerance)
+    try:
+        with multiprocessing.get_context("fork").Pool(workers, _init_line_worker, (threads_per_worker, workers)) as pool:
+            for results in pool.imap_unordered(_score_line_chunk, chunks):
+                yield from results
+    finally:
+        _worker_job = None
+
+
+def scoreprobs(thresh, line_width, selected_symbols, detections, st_ch, en_ch):
+    """
+    Folds the detections of a line into its probability matrix (no visualization).
+
+    Args:
+        thresh (float): The minimum score of a detection.
+        line_width (int): The width of the line image.
+        selected_symbols (list[Tuple[str, list[str]]]): The symbols with their selected images (see AlphabetBank.select_shots).
+        detections (list[dict]): The detections of the line, one entry per selected image in the same order
+            (None for an image that was not scored, see score_lines_adaptively).
+        st_ch (int): The first symbol (1-based).
+        en_ch (int): The last symbol (1-based).
+
+    Returns:
+        np.ndarray: The Pro_matrix, the highest score of every symbol (rows) at every column of the line.
+    """
+    Pro_matrix = np.zeros((en_ch-st_ch +1,line_width))
+
+    # the detections of all the images of all the symbols, with the row of their symbol
+    all_preds = iter(detections)
+    rows, boxes, scores = [], [], []
+    for p_c, (symbol, i_symbs) in enumerate(selected_symbols):
+        for symb in i_symbs:
+            preds = next(all_preds)
+            if preds is None:
+                continue
+            rows.append(np.full(len(preds['scores']), p_c))
+            boxes.append(preds['boxes'].cpu().numpy())
+            scores.append(preds['scores'].cpu().numpy().astype(np.float64))
+
+    if len(rows) > 0:
+        rows, boxes, scores = np.concatenate(rows), np.concatenate(boxes), np.concatenate(scores)
+        keep = scores > thresh
+        scatter_max_boxes(Pro_matrix, rows[keep], boxes[keep, 0], boxes[keep, 2], scores[keep])
+
+    return Pro_matrix
+
+
+def scored_shots(detections):
+    """The number of shots of a line that were scored (see score_lines_adaptively)."""
+    return sum(preds is not None for preds in detections)
+
+
+def scatter_max_boxes(matrix, rows, starts, ends, scores):
+    """
+    Writes the score of every box into its row of the matrix, over the columns it covers
+    (int(start) to int(end), end excluded), keeping the highest score where boxes overlap.
+
+    Args:
+        matrix (np.ndarray): The matrix to update in place.
+        rows (np.ndarray): The row of every box.
+        starts (np.ndarray): The start column (x1) of every box.
+        ends (np.ndarray): The end column (x2) of every box.
+        scores (np.ndarray): The score of every box.
+    """
+    # same columns as the slice matrix[row, int(start):int(end)]
+    starts = starts.astype(np.int64)
+    lengths = np.maximum(np.minimum(ends.astype(np.int64), matrix.shape[1]) - starts, 0)
+
+    # one entry per (box, covered column)
+    box_ids = np.repeat(np.arange(len(lengths)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    np.maximum.at(matrix, (rows[box_ids], starts[box_ids] + offsets), scores[box_ids])
+
+
+def drawcomposite(img1, Pro_matrix, selected_symbols, support_bank, resizing):
+    """
+    Draws the debug composite of a line: the line on top, then for every symbol one of its alphabet
+    images next to its row of the probability matrix, annotated with the scores.
+
+    Args:
+        img1 (Tensor): The line image.
+        Pro_matrix (np.ndarray): The probability matrix of the line (see scoreprobs).
+        selected_symbols (list[Tuple[str, list[str]]]): The symbols with their selected images (see AlphabetBank.select_shots).
+        support_bank (SupportFeatureBank): Gives the alphabet images.
+        resizing (bool): Whether the model uses the new resizing.
+
+    Returns:
+        PIL.Image: The composite image.
+    """
     mat_size  = 100
     img2_size = 105
     if resizing:
@@ -55,46 +443,15 @@ def drawprobs(model, device, alphabet_path, resizing, thresh, cipher, img1,shots
     image1 = Image.fromarray(img1.mul(255).permute(1, 2, 0).byte().numpy())
     image_f = Image.new('RGB', (mat_size, img2_size), (255, 255, 255))
     image_vline = Image.new('RGB', (5, img2_size), (0, 0, 255))
-    imgs_comb = np.hstack( (image_f,image_vline,image1) )
+    rows = [np.hstack( (image_f,image_vline,image1) )]
 
     
     font = ImageFont.truetype("src/arial.ttf", 25)
     
-    Pro_matrix = np.zeros((en_ch-st_ch +1,img1.size()[2]))
     last_max = 0
-    p_c = 0
-    for symbol in os.listdir(alphabet_path+'/'+cipher):
-        Matrix  = torch.zeros((3,mat_size,img1.size()[2]))
-        
-        i_symbs =  os.listdir(alphabet_path+'/'+cipher+'/'+symbol)
-        random.shuffle(i_symbs)
-        i_symbs = i_symbs[:shots] 
-
-        for symb in i_symbs:
-
-            try:
-                img2 = Image.open(alphabet_path+'/'+cipher+'/'+cipher+'/'+symbol+'/'+symb.split('.png')[0]+'.jpg').convert("RGB")
-            except:
-                img2 = Image.open(alphabet_path+'/'+cipher+'/'+symbol+'/'+symb.split('.jpg')[0]+'.jpg').convert("RGB")
-            if resizing:
-                img2 = img2.resize((img2_size,img2_size))
-            img2 = Fsupp.to_tensor(img2)
-
-            with torch.no_grad():
-                preds = model([img1.to(device)],[img2.to(device)])
-            preds = preds[0]
-            
-            
-        
-            for  box,lab in zip (preds['boxes'],range(preds['scores'].size()[0])):
-                if (preds['scores'][lab].item()>thresh):
-                    Mat = torch.zeros((3,mat_size,int(box[2].item())-int(box[0].item()))) + preds['scores'][lab].item()
-                    Matrix[:,:,int(box[0].item()):int(box[2].item()) ] = torch.max(Mat,Matrix[:,:,int(box[0].item()):int(box[2].item()) ]) 
-
-                    Pmat = np.zeros((1,int(box[2].item())-int(box[0].item()))) + preds['scores'][lab].item() 
-                    Pro_matrix[p_c,int(box[0].item()):int(box[2].item())] = np.maximum(Pmat,Pro_matrix[p_c,int(box[0].item()):int(box[2].item())])
-        p_c = p_c+1
 
+    for p_c, (symbol, i_symbs) in enumerate(selected_symbols):
+        Matrix = torch.from_numpy(Pro_matrix[p_c]).float().expand(3, mat_size, -1)
 
         Matrix_draw = Image.fromarray(Matrix.mul(255/1).permute(1, 2, 0).byte().numpy())
         draw = ImageDraw.Draw(Matrix_draw,mode='RGB')
@@ -108,15 +465,34 @@ def drawprobs(model, device, alphabet_path, resizing, thresh, cipher, img1,shots
             
 
             
+        img2 = support_bank.image(symbol, i_symbs[-1])
         image2 = Image.fromarray(img2.mul(255).permute(1, 2, 0).byte().numpy())
         
         image_vline = Image.new('RGB', (5, mat_size), (0, 0, 255))
         
-        img_comb = np.hstack( (image2.resize((mat_size,mat_size)),image_vline,Matrix_draw) )
-        imgs_comb = np.vstack( (imgs_comb,image_hline,img_comb) )
+        rows.append(image_hline)
+        rows.append(np.hstack( (image2.resize((mat_size,mat_size)),image_vline,Matrix_draw) ))
         
+    # stacked once at the end, stacking row by row copies the growing image for every symbol
+    imgs_comb = Image.fromarray(np.vstack(rows))
+    return imgs_comb
+
+
+def drawprobs(model, device, alphabet_path, resizing, thresh, cipher, img1,shots,st_ch,en_ch, support_bank=None, max_batch_size=None,
+              selected_symbols=None, detections=None):
+    if support_bank is None:
+        support_bank = SupportFeatureBank(model, device, alphabet_path, cipher, resizing)
+
+    # select the shots of every symbol, then score the line against all of them in batches,
+    # unless this was already done together with other lines (see draw_and_read)
+    if detections is None:
+        selected_symbols = support_bank.alphabet.select_shots(shots)
+        supports = [support_bank.get(symbol, symb) for symbol, i_symbs in selected_symbols for symb in i_symbs]
+        _, detections = next(score_lines(model, device, [img1], [supports], max_batch_size))
+
+    Pro_matrix = scoreprobs(thresh, img1.size()[2], selected_symbols, detections, st_ch, en_ch)
+    imgs_comb = drawcomposite(img1, Pro_matrix, selected_symbols, support_bank, resizing)
 
-    imgs_comb = Image.fromarray( imgs_comb)
     return imgs_comb, Pro_matrix
 
 
@@ -235,23 +611,84 @@ def drawprobs(model, device, alphabet_path, resizing, thresh, cipher, img1,shots
 
 
 # With or without reading SPACE-s.
-def read_sp_char_merged_version(matrix, thr, conf = 0.3, space=False):
-
+def column_stats(matrix, space=False, sp_th=20, widths=None):
+    """
+    Computes at once the per-column values the decoder (read_sp_char_merged_version) looks at.
+
+    Args:
+        matrix (np.ndarray): The score matrix of a line (symbols x columns), non-negative. Can also be
+            the score matrices of several lines, concatenated along the columns.
+        space (bool): Whether the blank windows are needed.
+        sp_th (int): The width of a blank window.
+        widths (list[int], optional): The widths of the concatenated lines, blank windows do not span
+            two lines. A single line if None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: For every column, its highest score, whether
+        a single symbol has it, the first symbol that has it, and whether the "sp_th" columns starting there
+        are all blank (only the columns which the decoder checks for spaces can be True).
+    """
     maxs = matrix.max(axis=0)
-    
+    at_max = matrix == maxs
+    unique = at_max.sum(axis=0) == 1
+    argmax = at_max.argmax(axis=0)
+
+    blank = np.zeros(matrix.shape[1], dtype=bool)
+    if space:
+        # number of inked columns before each column, a window is blank if it adds none
+        inked = np.concatenate(([0], np.cumsum(np.any(matrix != 0, axis=0))))
+        start = 0
+        for width in (widths if widths is not None else [matrix.shape[1]]):
+            checked = width - sp_th - 1
+            if checked > 0:
+                blank[start:start+checked] = inked[start+sp_th:start+sp_th+checked] == inked[start:start+checked]
+            start += width
+
+    return maxs, unique, argmax, blank
+
+
+def decode_columns(matrix, maxs, unique, argmax, blank, thr, conf = 0.3):
+    """
+    Decodes a line from its column values (see column_stats). The columns are grouped into runs
+    of identical values, a run is stepped through column by column only until its remaining
+    columns can no longer change the output, then they are counted at once.
+
+    Args:
+        matrix (np.ndarray): The score matrix of the line.
+        maxs, unique, argmax, blank (np.ndarray): The column values of the line (see column_stats).
+        thr (int): The minimum number of columns of a symbol.
+        conf (float): The minimum score of a symbol, "?" (-2) otherwise.
+
+    Returns:
+        Tuple[list[int], list[int]]: The symbols (-1: space, -2: below "conf") and their boxes (start and end columns).
+    """
+    width = matrix.shape[1]
+
     listchar = []
     list_boxes=[]
     
-    end_box=False
     occ = 0
     lastone=0
     last_max = 0
     sp_th=20
-    
-    
-    for z in range (matrix.shape[1]):
-        if space and (z<matrix.shape[1]-sp_th-1):
-            if (np.sum(matrix[:,z:z+sp_th]))==0 and len(listchar)>0 and listchar[-1] !=-1:
+
+    # runs of columns with the same values (symbol and score only matter if unique)
+    keys_symbol = np.where(unique, argmax, -1)
+    keys_score = np.where(unique, maxs, 0)
+    changes = (keys_symbol[1:] != keys_symbol[:-1]) | (keys_score[1:] != keys_score[:-1]) | (blank[1:] != blank[:-1])
+    run_starts = np.concatenate(([0], np.flatnonzero(changes) + 1)) if width > 0 else np.zeros(0, dtype=np.int64)
+    run_ends = np.append(run_starts[1:], width)
+
+    for run_start, run_end in zip(run_starts.tolist(), run_ends.tolist()):
+        for z in range(run_start, run_end):
+            if z > run_start and not (blank[z] and len(listchar)>0 and listchar[-1] !=-1) \
+                    and (not unique[z] or (argmax[z] == lastone and maxs[z] == last_max)):
+                # the rest of the run neither adds a space nor changes the symbol
+                if unique[z]:
+                    occ = occ + run_end - z
+                break
+
+            if blank[z] and len(listchar)>0 and listchar[-1] !=-1:
                 if occ >thr:
                     list_boxes.append(z-occ)
                     list_boxes.append(z)
@@ -266,26 +703,22 @@ def read_sp_char_merged_version(matrix, thr, conf = 0.3, space=False):
                 lastone = -1
                 last_max = 0
 
-        if (np.where(matrix[:,z] == maxs[z])[0].shape[0]==1):
-            a = (np.where(matrix[:,z] == maxs[z])[0][0])
-            if a!=lastone or last_max!= maxs[z]:
-                if occ > thr:
-
-                    list_boxes.append(z-occ)
-                    end_box = True
-                    if last_max >= conf:
-                        listchar.append(lastone)
-                    else:
-                        listchar.append(-2)
-                    occ = 0
-                lastone = a
-                last_max = maxs[z]
-                if end_box:
-                    list_boxes.append(z)
-                    end_box = False
+            if unique[z]:
+                a = argmax[z]
+                if a!=lastone or last_max!= maxs[z]:
+                    if occ > thr:
+                        list_boxes.append(z-occ)
+                        list_boxes.append(z)
+                        if last_max >= conf:
+                            listchar.append(lastone)
+                        else:
+                            listchar.append(-2)
+                        occ = 0
+                    lastone = a
+                    last_max = maxs[z]
+                else:
+                    occ = occ +1
 
-            else:
-                occ = occ +1
     if occ > thr:
         last_row = matrix[lastone]
 
@@ -314,23 +747,207 @@ def read_sp_char_merged_version(matrix, thr, conf = 0.3, space=False):
         
     return(listchar, list_boxes)
 
-def draw_and_read(model, device, alphabet_path, resizing, thresh, list_lines,lines_path,cipher,shots_number, log_path):
+
+def read_sp_char_merged_version(matrix, thr, conf = 0.3, space=False):
+    return decode_columns(matrix, *column_stats(matrix, space), thr, conf)
+
+
+def read_sp_char_batch(matrices, thr, conf = 0.3, space=False):
+    """
+    Decodes all the lines of a page (see read_sp_char_merged_version), the column values
+    of every line are computed in a single pass over the concatenated score matrices.
+
+    Args:
+        matrices (list[np.ndarray]): The score matrices of the lines, with the same symbols.
+        thr (int): The minimum number of columns of a symbol.
+        conf (float): The minimum score of a symbol, "?" (-2) otherwise.
+        space (bool): Whether spaces are read.
+
+    Returns:
+        list[Tuple[list[int], list[int]]]: The symbols and boxes of every line.
+    """
+    if len(matrices) == 0:
+        return []
+
+    widths = [matrix.shape[1] for matrix in matrices]
+    stats = column_stats(np.concatenate(matrices, axis=1), space, widths=widths)
+    offsets = np.cumsum([0] + widths)
+
+    return [
+        decode_columns(matrix, *[values[start:end] for values in stats], thr, conf)
+        for matrix, start, end in zip(matrices, offsets[:-1], offsets[1:])
+    ]
+
+def resize_to_bucket(img1, buckets):
+    """
+    Resizes a line for the resizing models keeping its aspect ratio: the line is scaled to a height
+    of 128, then padded on the right (with its median color) to the smallest width bucket it fits in.
+    Lines wider than the largest bucket are squeezed into it, like with the fixed 2048x128 resizing.
+
+    Args:
+        img1 (PIL.Image): The line image.
+        buckets (list[int]): The widths of the buckets, e.g. (512, 1024, 2048).
+
+    Returns:
+        PIL.Image: The line, of size (bucket, 128).
+        int: The width of the line content, the rest is padding.
+    """
+    width = max(1, int(round(img1.width * 128 / img1.height)))
+    bucket = next((b for b in sorted(buckets) if b >= width), max(buckets))
+    width = min(width, bucket)
+
+    content = img1.resize((width,128))
+    background = tuple(int(c) for c in np.median(np.asarray(content).reshape(-1, 3), axis=0))
+    line = Image.new("RGB", (bucket,128), background)
+    line.paste(content, (0,0))
+
+    return line, width
+
+
+def to_resized_width(matrix, content_width, width=2048):
+    """
+    Maps the Pro_matrix of a line resized with resize_to_bucket to the columns of the fixed 2048x128
+    resizing, which the decoding and the box coordinates of the resizing models refer to.
+    """
+    return matrix[:, (np.arange(width) * content_width) // width]
+
+
+def score_line_matrices(model, device, lines, supports_per_line, selected_symbols_per_line, thresh, symbols_number, max_batch_size=None,
+                        line_batch_size=LINE_BATCH_SIZE, workers=1, threads_per_worker=None, shared_proposals=False, skip_blank=False,
+                        adaptive_shots=False, shot_tolerance=SHOT_TOLERANCE, log_path=None):
+    """
+    Probability matrices of lines, see draw_and_read for the options. With "adaptive_shots", the number
+    of shots scored is reported in the log.
+
+    Arguments:
+        lines (list[Tensor]): The line images.
+        supports_per_line (list[list[Tensor]]): The support features of every line.
+        selected_symbols_per_line (list[list[Tuple[str, list]]]): The symbols and shots of every line, as
+            returned by AlphabetBank.select_shots. The rows of the matrices follow their order.
+        symbols_number (int): The number of rows of the matrices.
+        log_path (str, optional): The log file.
+
+    Yields:
+        Tuple[int, np.ndarray]: The index of a line and its matrix, as soon as all its segments are scored
+        (the lines are not done in order).
+    """
+    # the lines are scored in segments: their inked spans, or the whole line
+    segments = [
+        (i, start, end) for i, img in enumerate(lines)
+        for start, end in (ink_segments(img) if skip_blank else [(0, img.shape[-1])])
+    ]
+    segment_lines = [lines[i][:, :, start:end] for i, start, end in segments]
+    segment_supports = [supports_per_line[i] for i, _, _ in segments]
+    segment_symbols = [selected_symbols_per_line[i] for i, _, _ in segments]
+
+    # segments are scored in batches of similar width, so they are done out of order
+    if workers > 1 and device.type == 'cpu' and len(segments) > 1 and "fork" in multiprocessing.get_all_start_methods():
+        scored_segments = score_lines_in_workers(model, segment_lines, segment_supports, segment_symbols, thresh, symbols_number,
+                                                 max_batch_size, line_batch_size, workers, threads_per_worker, shared_proposals,
+                                                 adaptive_shots, shot_tolerance)
+    else:
+        if adaptive_shots:
+            scored_detections = score_lines_adaptively(model, device, segment_lines, segment_supports, segment_symbols, thresh, symbols_number,
+                                                       max_batch_size, line_batch_size, shared_proposals, shot_tolerance)
+        else:
+            scored_detections = score_lines(model, device, segment_lines, segment_supports, max_batch_size, line_batch_size, shared_proposals)
+        scored_segments = (
+            (k, scoreprobs(thresh, segment_lines[k].size()[2], segment_symbols[k], detections, 1, symbols_number), scored_shots(detections))
+            for k, detections in scored_detections
+        )
+
+    # the matrices of the segments are put back at their columns of the line, blank columns score 0
+    matrices = [None] * len(lines)
+    remaining = [0] * len(lines)
+    for i, _, _ in segments:
+        remaining[i] += 1
+
+    scored = 0
+    for k, matrix, segment_shots in scored_segments:
+        scored += segment_shots
+        i, start, end = segments[k]
+        if (start, end) == (0, lines[i].shape[-1]):
+            matrices[i] = matrix
+        else:
+            if matrices[i] is None:
+                matrices[i] = np.zeros((symbols_number, lines[i].shape[-1]))
+            matrices[i][:, start:end] = matrix
+
+        remaining[i] -= 1
+        if remaining[i] == 0:
+            yield i, matrices[i]
+            matrices[i] = None
+
+    if adaptive_shots and log_path is not None:
+        planned = sum(len(supports) for supports in segment_supports)
+        with open(log_path, "a") as file:
+            file.write('{} Adaptive shots: {}/{} shots scored, {} saved \n'.format(
+                time.strftime("%Y.%m.%d-%H.%M.%S"), scored, planned, planned - scored))
+
+
+def draw_and_read(model, device, alphabet_path, resizing, thresh, list_lines,lines_path,cipher,shots_number, log_path, support_bank=None, max_batch_size=None,
+                  line_batch_size=LINE_BATCH_SIZE, debug_path=None, workers=1, threads_per_worker=None, seed=None, shared_proposals=False,
+                  line_mode=False, skip_blank=False, resize_buckets=None, adaptive_shots=False, shot_tolerance=SHOT_TOLERANCE):
+    """
+    Few-shot prediction of lines. Only the probability matrices are computed, the debug composites
+    of drawprobs are saved to "debug_path" (one image per line, same file name) if it is given.
+    On the CPU, the lines are shared between "workers" processes if there are more than one
+    (see score_lines_in_workers). If a "seed" is given, the shots of a line only depend on the seed
+    and on the line name, otherwise they are drawn from the global random generator. With
+    "shared_proposals", a line has one proposal set for all its supports (see score_lines). With
+    "line_mode", the anchors and the number of proposals fit the lines and the alphabet (see line_anchors.py).
+    With "skip_blank", only the inked segments of the lines are scored (see ink_segments.py).
+    With "resize_buckets", the resizing models keep the aspect ratio of the lines (see resize_to_bucket);
+    the matrices are still returned in the columns of the 2048x128 resizing.
+    With "adaptive_shots", the shots of a symbol are scored one after the other until one of them no
+    longer changes its row by more than "shot_tolerance" (see score_lines_adaptively).
+    """
     
     model.eval()
-    matrices = []
-    
-    # stop=0
-    # i=0
-    for i, t in enumerate(list_lines):
+
+    # the support features are computed at most once per job (or loaded from the on-disk bank)
+    if support_bank is None:
+        support_bank = SupportFeatureBank(model, device, alphabet_path, cipher, resizing)
+
+    # the shots are selected line after line, as if the lines were scored one by one
+    lines = []
+    content_widths = []
+    selected_symbols_per_line = []
+    for t in list_lines:
         img1 = Image.open(lines_path+'/'+cipher+'/'+t).convert("RGB")
-        if resizing:
+        content_width = None
+        if resizing and resize_buckets:
+            img1, content_width = resize_to_bucket(img1, resize_buckets)
+        elif resizing:
             img1 = img1.resize((2048,128))
-        img1 = Fsupp.to_tensor(img1)
-
-        _, matrix = drawprobs(model, device, alphabet_path, resizing, thresh, cipher,img1,shots_number,1,len(os.listdir(alphabet_path+'/'+cipher)))
-        matrices.append(matrix)
+        lines.append(Fsupp.to_tensor(img1))
+        content_widths.append(content_width)
+        rng = random if seed is None else random.Random('{}|{}'.format(seed, t))
+        selected_symbols_per_line.append(support_bank.alphabet.select_shots(shots_number, rng))
+
+    symbols_number = len(support_bank.alphabet.symbols)
+
+    if line_mode:
+        model = line_mode_model(model, line_mode_config(model, [img.shape[-2:] for img in lines], support_bank.alphabet), log_path)
+
+    supports_per_line = [
+        [support_bank.get(symbol, symb) for symbol, i_symbs in selected_symbols for symb in i_symbs]
+        for selected_symbols in selected_symbols_per_line
+    ]
+    scored_lines = score_line_matrices(model, device, lines, supports_per_line, selected_symbols_per_line, thresh, symbols_number,
+                                       max_batch_size, line_batch_size, workers, threads_per_worker, shared_proposals, skip_blank,
+                                       adaptive_shots, shot_tolerance, log_path)
+
+    matrices = [None] * len(list_lines)
+    for done, (i, matrix) in enumerate(scored_lines, 1):
+        matrices[i] = matrix
+        if debug_path is not None:
+            os.makedirs(debug_path, exist_ok=True)
+            drawcomposite(lines[i], matrices[i], selected_symbols_per_line[i], support_bank, resizing).save(os.path.join(debug_path, list_lines[i]))
+        if content_widths[i] is not None:
+            matrices[i] = to_resized_width(matrices[i], content_widths[i])
         with open(log_path, "a") as file:
-            file.write('{} Progression: line {}/{} \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), i+1, len(list_lines)))
+            file.write('{} Progression: line {}/{} \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), done, len(list_lines)))
 
 
     return(matrices)
@@ -338,9 +955,7 @@ def draw_and_read(model, device, alphabet_path, resizing, thresh, list_lines,lin
 def zid_read(threshold, matrices, read_space=False):
     results = []
     box_results = []
-    for matrix in matrices:
-
-        l_ch,l_boxes = read_sp_char_merged_version(matrix, 22, threshold, read_space)
+    for l_ch,l_boxes in read_sp_char_batch(matrices, 22, threshold, read_space):
 
         # if read_space:
         #     l_ch,l_boxes = read_sp_char(matrix,22,conf= threshold)
@@ -358,8 +973,9 @@ def zid_read(threshold, matrices, read_space=False):
         box_results.append(l_boxes)
     return results, box_results
 
-def inttosymbs(alphabet_path, preds, cipher):
-    alphabet_symbs = os.listdir(alphabet_path+'/'+cipher) 
+def inttosymbs(alphabet_path, preds, cipher, alphabet_symbs=None):
+    if alphabet_symbs is None:
+        alphabet_symbs = os.listdir(alphabet_path+'/'+cipher) 
     pred_lines = []
     
     for pr in preds:
@@ -0,0 +1,70 @@
+# ************************************************************************************************************
+# Inked spans of a line image, for the Few-shot prediction. Line boxes drawn by the users are generous and
+# historical lines often have long blank margins or gaps, which would otherwise go through the network for
+# every support. A column is inked if it has a few pixels clearly darker than the background (the median of
+# the line); the blank margins are trimmed and blank runs longer than MIN_GAP_HEIGHTS line heights split the
+# line. Every segment keeps some blank padding around its ink and is at least as wide as the line is high, so
+# that the model transform scales it like the whole line.
+#
+# ************************************************************************************************************
+
+import numpy as np
+
+INK_THRESHOLD = 0.25 # a pixel is ink if it is this much darker than the background (intensities in [0, 1])
+MIN_INK_PIXELS = 2 # number of ink pixels a column needs to be inked, lower counts are treated as noise
+MIN_GAP_HEIGHTS = 1.0 # blank runs longer than this many line heights split the line
+PADDING_HEIGHTS = 0.25 # blank margin kept on both sides of a segment, in line heights
+
+
+def inked_columns(img):
+    """
+    Args:
+        img (Tensor[3, H, W]): The line image, as given to the model.
+
+    Returns:
+        np.ndarray[W]: Whether every column of the line is inked.
+    """
+    gray = img.mean(0)
+    ink = (gray.median() - gray) > INK_THRESHOLD
+    return (ink.sum(0) >= MIN_INK_PIXELS).cpu().numpy()
+
+
+def ink_segments(img):
+    """
+    Splits a line into its inked segments.
+
+    Args:
+        img (Tensor[3, H, W]): The line image, as given to the model.
+
+    Returns:
+        list[Tuple[int, int]]: The start and end (excluded) columns of the segments, in order and
+        without overlap. The whole line if no ink is found, so that a faint line is still predicted.
+    """
+    height, width = img.shape[-2:]
+    columns = np.flatnonzero(inked_columns(img))
+    if len(columns) == 0:
+        return [(0, width)]
+
+    # runs of inked columns separated by long blank gaps
+    gaps = np.diff(columns) > MIN_GAP_HEIGHTS * height
+    starts = columns[np.r_[True, gaps]]
+    ends = columns[np.r_[gaps, True]] + 1
+
+    padding = int(PADDING_HEIGHTS * height)
+    segments = []
+    for start, end in zip(starts, ends):
+        start, end = max(0, start - padding), min(width, end + padding)
+
+        # at least as wide as high, centered on the ink
+        missing = height - (end - start)
+        if missing > 0:
+            start = max(0, start - missing // 2)
+            end = min(width, start + height)
+            start = max(0, end - height)
+
+        if len(segments) > 0 and start <= segments[-1][1]:
+            segments[-1] = (segments[-1][0], int(max(segments[-1][1], end)))
+        else:
+            segments.append((int(start), int(end)))
+
+    return segments
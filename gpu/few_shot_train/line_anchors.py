@@ -0,0 +1,161 @@
+# ************************************************************************************************************
+# "Line mode" of the RPN for the Few-shot prediction. The model is built with generic anchors (sizes 32..512 x
+# aspect ratios 0.5, 1, 2 on every feature location) and keeps up to 1000 proposals per line, but its inputs
+# are text lines of a known height (128 px after the transform) and its targets are alphabet symbols of known
+# shapes. For a job, the line mode:
+#   - keeps only the anchors that can overlap a symbol box: anchors whose best IoU with the plausible symbol
+#     boxes is below the background threshold of the RPN training (rpn_bg_iou_thresh) were always negatives,
+#   - lowers rpn_pre/post_nms_top_n_test to a number of proposals per symbol that fits in the widest line.
+# The anchors are pruned by selecting the matching outputs of the trained RPN head, no retraining is needed.
+# The plausible symbol boxes are the aspect ratios of the alphabet images at SYMBOL_HEIGHT_FRACTIONS of the
+# line height.
+#
+# ************************************************************************************************************
+
+import copy
+import math
+import time
+import torch
+from torch import nn
+from few_shot_train.src.rpn import AnchorGenerator
+
+SYMBOL_HEIGHT_FRACTIONS = (0.25, 0.5, 0.75, 1.0) # heights of the plausible symbol boxes, relative to the line height
+PROPOSALS_PER_SYMBOL = 8 # proposals kept per symbol that fits in the widest line
+PRE_NMS_FACTOR = 2 # proposals kept before the NMS, relative to the ones kept after it
+
+
+class LineAnchorGenerator(AnchorGenerator):
+    """The anchors of an AnchorGenerator restricted to the ones at the given indices (per location)."""
+
+    def __init__(self, anchor_generator, keep):
+        super(LineAnchorGenerator, self).__init__(anchor_generator.sizes, anchor_generator.aspect_ratios)
+        self.keep = keep
+
+    def set_cell_anchors(self, device):
+        if self.cell_anchors is not None:
+            return self.cell_anchors
+        super(LineAnchorGenerator, self).set_cell_anchors(device)
+        self.cell_anchors = [base_anchors[self.keep] for base_anchors in self.cell_anchors]
+
+    def num_anchors_per_location(self):
+        return [len(self.keep)]
+
+
+class LineRPNHead(nn.Module):
+    """The outputs of an RPN head restricted to the anchors at the given indices (per location)."""
+
+    def __init__(self, head, keep):
+        super(LineRPNHead, self).__init__()
+        self.head = head
+        self.pool_support = head.pool_support
+        self.keep = keep
+
+    def forward(self, x, pooled_support):
+        logits, bbox_reg = self.head(x, pooled_support)
+        index = torch.as_tensor(self.keep, dtype=torch.int64, device=logits[0].device)
+        bbox_index = (index[:, None] * 4 + torch.arange(4, device=index.device)).view(-1)
+        return [l.index_select(1, index) for l in logits], [b.index_select(1, bbox_index) for b in bbox_reg]
+
+
+def transformed_size(model, height, width):
+    """The size of a line after the resizing of the model transform (GeneralizedRCNNTransform, eval mode)."""
+    min_size = model.transform.min_size[-1]
+    scale = min(min_size / min(height, width), model.transform.max_size / max(height, width))
+    return height * scale, width * scale
+
+
+def symbol_boxes(alphabet, line_height):
+    """
+    Returns the (width, height) of the plausible symbol boxes of a line: every aspect ratio of the
+    alphabet images at every height of SYMBOL_HEIGHT_FRACTIONS. The sizes are read from the image
+    headers, the images are not decoded (see AlphabetBank.size).
+    """
+    aspect_ratios = {
+        round(width / height, 2)
+        for symbol in alphabet.symbols for symb in alphabet.images[symbol]
+        for width, height in [alphabet.size(symbol, symb)]
+    }
+    return torch.tensor([
+        [aspect_ratio * fraction * line_height, fraction * line_height]
+        for aspect_ratio in sorted(aspect_ratios) for fraction in SYMBOL_HEIGHT_FRACTIONS
+    ])
+
+
+def line_mode_config(model, line_sizes, alphabet):
+    """
+    Derives the line mode of the RPN from the lines of a job and the alphabet.
+
+    Args:
+        model (torch.nn.Module): The Few-shot model.
+        line_sizes (list[Tuple[int, int]]): The (height, width) of the lines, as given to the model.
+        alphabet (AlphabetBank): The images of the alphabet.
+
+    Returns:
+        dict: The indices of the anchors kept per location ("keep"), their number before the pruning
+        ("anchors"), and the numbers of proposals kept before and after the NMS ("pre_nms_top_n",
+        "post_nms_top_n"), as well as the defaults of the model ("default_pre_nms_top_n", "default_post_nms_top_n").
+    """
+    rpn = model.rpn
+    anchor_generator = rpn.anchor_generator
+    sizes = [transformed_size(model, height, width) for height, width in line_sizes]
+    line_height = max(height for height, _ in sizes)
+    line_width = max(width for _, width in sizes)
+
+    # the model has a single feature map (VGG16), so a single set of anchors per location
+    base_anchors = anchor_generator.generate_anchors(anchor_generator.sizes[0], anchor_generator.aspect_ratios[0])
+    anchors = torch.stack([base_anchors[:, 2] - base_anchors[:, 0], base_anchors[:, 3] - base_anchors[:, 1]], dim=1)
+    boxes = symbol_boxes(alphabet, line_height)
+
+    # IoU of centered boxes: only their shapes matter, the anchors are placed on every location
+    inter = torch.min(anchors[:, None, 0], boxes[None, :, 0]) * torch.min(anchors[:, None, 1], boxes[None, :, 1])
+    union = (anchors[:, 0] * anchors[:, 1])[:, None] + (boxes[:, 0] * boxes[:, 1])[None, :] - inter
+    best_iou = (inter / union).max(dim=1).values
+
+    keep = torch.nonzero(best_iou >= rpn.proposal_matcher.low_threshold).view(-1).tolist()
+    if len(keep) == 0:
+        keep = [int(best_iou.argmax())]
+
+    max_symbols = math.ceil(line_width / float(boxes[:, 0].min()))
+    post_nms_top_n = min(rpn._post_nms_top_n['testing'], PROPOSALS_PER_SYMBOL * max_symbols)
+    pre_nms_top_n = min(rpn._pre_nms_top_n['testing'], PRE_NMS_FACTOR * post_nms_top_n)
+
+    return dict(
+        keep=keep,
+        anchors=len(anchors),
+        pre_nms_top_n=pre_nms_top_n,
+        post_nms_top_n=post_nms_top_n,
+        default_pre_nms_top_n=rpn._pre_nms_top_n['testing'],
+        default_post_nms_top_n=rpn._post_nms_top_n['testing'],
+    )
+
+
+def line_mode_model(model, config, log_path=None):
+    """
+    Returns the model with the line mode of its RPN (see line_mode_config), for inference.
+
+    Args:
+        model (torch.nn.Module): The Few-shot model. It is not modified (e.g. a model shared by several jobs).
+        config (dict): The line mode, as returned by line_mode_config.
+        log_path (str, optional): The log file, where the line mode is reported.
+
+    Returns:
+        model (torch.nn.Module): A shallow copy of the model sharing its weights, with the line mode RPN.
+    """
+    rpn = copy.copy(model.rpn)
+    rpn._modules = copy.copy(model.rpn._modules)
+    rpn.anchor_generator = LineAnchorGenerator(model.rpn.anchor_generator, config["keep"])
+    rpn.head = LineRPNHead(model.rpn.head, config["keep"])
+    rpn._pre_nms_top_n = dict(model.rpn._pre_nms_top_n, testing=config["pre_nms_top_n"])
+    rpn._post_nms_top_n = dict(model.rpn._post_nms_top_n, testing=config["post_nms_top_n"])
+
+    line_model = copy.copy(model)
+    line_model._modules = copy.copy(model._modules)
+    line_model.rpn = rpn
+
+    if log_path is not None:
+        with open(log_path, "a") as file:
+            file.write('{} Line mode: {}/{} anchors per location, {}/{} proposals before the NMS, {}/{} after it \n'.format(
+                time.strftime("%Y.%m.%d-%H.%M.%S"), len(config["keep"]), config["anchors"],
+                config["pre_nms_top_n"], config["default_pre_nms_top_n"], config["post_nms_top_n"], config["default_post_nms_top_n"]))
+
+    return line_model
@@ -1,6 +1,7 @@
 from PIL import Image
 import os
 import torch
+import numpy as np
 import sys
 import cv2 
 import few_shot_train.transforms as T 
@@ -8,6 +9,7 @@ import few_shot_train.utils as utils
 # import transforms as T 
 import torchvision.transforms as torchT
 import torchvision.transforms.functional as TF
+from few_shot_train.support_bank import AlphabetBank, support_image_path
 
 # import utils
 # from configs import getOptions
@@ -72,6 +74,31 @@ def get_data2(input_path, labeling=False):
 
 
 
+class ImageStore(object):
+    """
+    Decoded images, kept in memory as uint8 tensors (3, H, W): every image file is read and decoded once,
+    the samples only copy them. Filled before the DataLoader workers are forked (see preload), the workers
+    share it instead of decoding the images again.
+    """
+
+    def __init__(self):
+        self.images = {}
+        self.sizes = {}
+
+    def load(self, path, size=None):
+        """
+        Returns the image at "path", resized to "size" (width, height) if it is given. Its size before
+        the resizing is kept in "sizes".
+        """
+        if (path, size) not in self.images:
+            img = Image.open(path).convert("RGB")
+            self.sizes[path] = img.size
+            if size is not None:
+                img = img.resize(size)
+            self.images[(path, size)] = torch.from_numpy(np.array(img)).permute(2, 0, 1).contiguous()
+        return self.images[(path, size)]
+
+
 class readQuerySupport(object):
     def __init__(self, root, alphabet, cipher, resizing, Xdata, augment, transforms):
         self.Xdata = Xdata
@@ -87,25 +114,40 @@ class readQuerySupport(object):
         for i in range (len(self.listimg)):
             for c in range (augment):
                 self.imgs.append([self.listimg[i],c])
+
+        # the alphabet is listed once, the images are decoded on first use
+        self.alphabet_bank = AlphabetBank(alphabet, cipher, resizing)
+        self.store = ImageStore()
+        self.line_size = (2048,128) if self.resizing else None
+        self.support_size = (128,128) if self.resizing else None
+
+    def line_path(self, filepath):
+        """The line images are named .png in the annotation but may be stored as .jpg."""
+        if os.path.isfile(filepath):
+            return filepath
+        return filepath.split('.png')[0]+'.jpg'
+
+    def support_path(self, symbol, symb):
+        return support_image_path(self.alphabet, self.cipher, symbol, symb)
+
+    def preload(self):
+        """Decodes all the training lines and the alphabet images of their symbols."""
+        for key in self.listimg:
+            self.store.load(self.line_path(self.Xdata[key]['filepath']), self.line_size)
+        for symbol in {self.Xdata[key]['class'] for key in self.listimg}:
+            for symb in self.alphabet_bank.images[symbol]:
+                self.store.load(self.support_path(symbol, symb), self.support_size)
+
     def __getitem__(self, idx):
 
         img_path = self.imgs[idx][0]
-        
-        
-        images_choices = os.listdir(self.alphabet+'/'+self.cipher+'/'+self.Xdata[img_path]['class']+'/') ###########
-        random.shuffle(images_choices)
-
-        try:
-            img1 = Image.open(self.Xdata[img_path]['filepath']).convert("RGB")
-        except:
-            img1 = Image.open(self.Xdata[img_path]['filepath'].split('.png')[0]+'.jpg').convert("RGB")
-        try:
-            img2 = Image.open(self.alphabet+'/'+self.cipher+'/'+self.Xdata[img_path]['class']+'/'+random.choice(images_choices).split('.png')[0]+'.jpg').convert("RGB")
-        
-        except:
-            img2 = Image.open(self.alphabet+'/'+self.cipher+'/'+self.Xdata[img_path]['class']+'/'+random.choice(images_choices).split('.jpg')[0]+'.jpg').convert("RGB")
-        
-        image_size = img1.size
+        symbol = self.Xdata[img_path]['class']
+
+        line_path = self.line_path(self.Xdata[img_path]['filepath'])
+        img1 = self.store.load(line_path, self.line_size)
+        img2 = self.store.load(self.support_path(symbol, random.choice(self.alphabet_bank.images[symbol])), self.support_size)
+
+        image_size = self.store.sizes[line_path]
         
         if self.resizing:
             resize_factors = [2048/image_size[0], 128/image_size[1]]
@@ -123,10 +165,6 @@ class readQuerySupport(object):
             boxes.append([xmin, ymin, xmax, ymax])
             labels.append(self.Xdata[img_path]['bboxes'][j]['class'])
 
-        if self.resizing:
-            img1 = img1.resize((2048,128))
-            img2 = img2.resize((128,128))
-
         boxes = torch.as_tensor(boxes, dtype=torch.float32)
         # there is only one class
         labels = torch.as_tensor(labels, dtype=torch.int64)
@@ -155,7 +193,7 @@ class readQuerySupport(object):
 
             
             # transform image 2 (alphabet symbol from the server)
-            alphabet_symbol_img_size = img2.size
+            alphabet_symbol_img_size = (img2.shape[-1], img2.shape[-2])
             img2_transf,_ = self.transforms(img2,None)#Fsupp.to_tensor(img2)#
             if alphabet_symbol_img_size[0] > 50:
                 i, j, h, w = torchT.RandomCrop.get_params(img2_transf, output_size=(image_size[1]-8, alphabet_symbol_img_size[0]-8)) #  image_size[1]-8
@@ -174,15 +212,23 @@ class readQuerySupport(object):
 
 def get_transform():
     transforms = []
-    transforms.append(T.ToTensor())
+    transforms.append(T.ConvertImageDtype(torch.float)) # the images are decoded as uint8 tensors (see ImageStore)
     return T.Compose(transforms)
 
-def load_data(batch_s,shots_number,root, alphabet, cipher, resizing, txtfile=None, L=None):
+def load_data(batch_s,shots_number,root, alphabet, cipher, resizing, txtfile=None, L=None,
+              num_workers=4, persistent_workers=False, prefetch_factor=2, pin_memory=False):
     if txtfile:
         L = get_data2(txtfile,False)
 
     dataset_lab = readQuerySupport(root, alphabet, cipher, resizing, L, shots_number, get_transform())
-    data_loader = torch.utils.data.DataLoader(dataset_lab, batch_size=batch_s, shuffle=True, num_workers=4, collate_fn=utils.collate_fn)
+    dataset_lab.preload()
+
+    # the worker options are only accepted with worker processes
+    worker_options = {}
+    if num_workers > 0:
+        worker_options = dict(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+    data_loader = torch.utils.data.DataLoader(dataset_lab, batch_size=batch_s, shuffle=True, num_workers=num_workers, collate_fn=utils.collate_fn,
+                                              pin_memory=pin_memory, **worker_options)
     
     return dataset_lab,data_loader
 
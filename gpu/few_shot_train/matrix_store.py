@@ -0,0 +1,136 @@
+# ************************************************************************************************************
+# Store of the raw Few-shot score matrices (Pro_matrix) of the predicted lines. The threshold and the reading
+# of spaces only affect the decoding of these matrices (zid_read/inttosymbs), so trying other values does not
+# need the network again: the matrices are saved as compressed arrays, keyed by the line crop, the model, the
+# alphabet, the number of shots and the options of the scoring (line mode, shot seed, ...), and the lines are
+# simply decoded again.
+#
+# The matrices are stored with the lowest threshold accepted on the frontend (STORED_THRESHOLD). The matrix of
+# any higher threshold is obtained by zeroing the scores below it (see apply_threshold), which is exactly what
+# the prediction with that threshold gives.
+#
+# The store is capped at MAX_STORE_BYTES: the least recently used matrices are removed once it grows larger.
+#
+# ************************************************************************************************************
+
+import os
+import json
+import hashlib
+import numpy as np
+from few_shot_train.support_bank import model_fingerprint
+
+STORED_THRESHOLD = 0.01 # minimum of "thresholdFewShots" (see run_gpu_python_code.php)
+MAX_STORE_BYTES = 1024**3 # size of the stored matrices above which the least recently used ones are removed
+
+
+def apply_threshold(matrix, thresh):
+    """
+    Converts a score matrix computed with a lower threshold to the one of "thresh".
+
+    Args:
+        matrix (np.ndarray): A score matrix (see htr_utils.scoreprobs).
+        thresh (float): The new threshold, not lower than the one of the matrix.
+
+    Returns:
+        np.ndarray: The score matrix of "thresh".
+    """
+    return np.where(matrix > thresh, matrix, 0)
+
+
+class ScoreMatrixStore(object):
+    """
+    Score matrices of lines, one compressed "<key>.npz" file per line in "store_path".
+
+    Args:
+        store_path (str): The folder of the stored matrices, created if needed.
+        model_path (str): The path to the saved model weights.
+        cipher (str): The name of the alphabet.
+        shots (int): The number of images per symbol.
+        resizing (bool): Whether the model uses the new resizing.
+        options (dict, optional): The other options that change the scores (see run_recognition), they must
+            be JSON serializable.
+        max_bytes (int): The size above which the least recently used matrices are removed (see cleanup).
+    """
+
+    def __init__(self, store_path, model_path, cipher, shots, resizing, options=None, max_bytes=MAX_STORE_BYTES):
+        self.store_path = store_path
+        self.fingerprint = model_fingerprint(model_path)
+        self.cipher = cipher
+        self.shots = shots
+        self.resizing = resizing
+        self.options = json.dumps(options or {}, sort_keys=True)
+        self.max_bytes = max_bytes
+
+    def key(self, line_path):
+        """Hashes the line crop (file content) together with the model, alphabet, shots, resizing flag and options."""
+        h = hashlib.sha1()
+        with open(line_path, "rb") as f:
+            h.update(hashlib.sha1(f.read()).digest())
+        h.update(f"{self.fingerprint}|{self.cipher}|{self.shots}|{self.resizing}|{self.options}".encode("utf-8"))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.store_path, f"{key}.npz")
+
+    def load(self, line_path):
+        """
+        Returns the stored score matrix of a line (computed with STORED_THRESHOLD), or None if there is none.
+        """
+        path = self.path(self.key(line_path))
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with np.load(path) as stored:
+                matrix = stored["matrix"]
+        except Exception:
+            # a corrupt file is simply computed again
+            return None
+
+        # the modification time orders the matrices by their last use (see cleanup)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return matrix
+
+    def save(self, line_path, matrix):
+        """Stores (atomically) the score matrix of a line, computed with STORED_THRESHOLD."""
+        os.makedirs(self.store_path, exist_ok=True)
+        path = self.path(self.key(line_path))
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, matrix=matrix)
+        os.replace(tmp_path, path)
+
+    def cleanup(self):
+        """
+        Removes the least recently used matrices (saved or loaded) until the store is not larger than max_bytes.
+
+        Returns:
+            int: The number of removed matrices.
+        """
+        if not os.path.isdir(self.store_path):
+            return 0
+
+        stored = []
+        for entry in os.scandir(self.store_path):
+            if entry.name.endswith(".npz") and not entry.name.endswith(".tmp.npz"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue # removed by another job
+                stored.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in stored)
+        removed = 0
+        for _, size, path in sorted(stored):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+            total -= size
+
+        return removed
@@ -0,0 +1,61 @@
+# ************************************************************************************************************
+# Least-recently-used cache of loaded Few-shot models. Used by the resident inference daemon
+# (few_shot_daemon.py), so that consecutive predictions with the same model skip building the network and
+# loading its weights. A cached model is loaded again if its file changed since (e.g. a user model which was
+# fine-tuned in the meantime).
+#
+# ************************************************************************************************************
+
+import os
+import torch
+from collections import OrderedDict
+from few_shot_train.support_bank import model_fingerprint
+
+
+class ModelCache(object):
+    """
+    Keeps up to "capacity" models in memory, keyed by model file and device.
+
+    Args:
+        capacity (int): The maximum number of models kept.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model_path, device, init_model):
+        """
+        Returns the model of "model_path" on "device", loading it with "init_model" if it is not cached.
+
+        Args:
+            model_path (str): The path to the saved model weights.
+            device (torch.device): The device of the model.
+            init_model (callable): Builds and loads a model, called as init_model(device, model_path).
+
+        Returns:
+            model (torch.nn.Module): The model. It is shared between calls, do not modify it.
+        """
+        key = (os.path.abspath(model_path), str(device))
+        fingerprint = model_fingerprint(model_path)
+
+        entry = self.models.get(key)
+        if entry is not None and entry[0] == fingerprint:
+            self.hits += 1
+            self.models.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        self.models.pop(key, None)
+        model = init_model(device, model_path)
+        self.models[key] = (fingerprint, model)
+
+        while len(self.models) > self.capacity:
+            _, (_, evicted) = self.models.popitem(last=False)
+            del evicted
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        return model
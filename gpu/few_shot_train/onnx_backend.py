@@ -0,0 +1,253 @@
+# ************************************************************************************************************
+# ONNX Runtime backend of the Few-shot prediction on CPU. The dense parts of the model are exported to ONNX
+# and run by ONNX Runtime with a tuned number of threads:
+#   - the VGG16 backbone (line and alphabet images -> feature maps),
+#   - the RPN head (line features x pooled support -> objectness, box deltas),
+#   - the box head (merged RoI features -> TwoMLPHead 25088->512->512).
+# The steps between them (anchors, proposal decoding and NMS, RoIAlign) and the small FastRCNNPredictor stay in
+# PyTorch, so the whole pipeline (support bank, batching, decoding) is unchanged.
+#
+# The graphs are exported once per model into the ONNX folder and checked against the PyTorch modules: the
+# backend is only used if the outputs agree within ONNX_TOLERANCE. If onnxruntime is not installed, or the
+# export or the check fails, the prediction falls back to the PyTorch model.
+#
+# ************************************************************************************************************
+
+import os
+import copy
+import json
+import time
+import numpy as np
+import torch
+from torch import nn
+from few_shot_train.support_bank import model_fingerprint
+
+BACKEND_PYTORCH = "pytorch"
+BACKEND_ONNX = "onnxruntime"
+
+ONNX_OPSET = 11 # highest opset supported by all the PyTorch versions in use
+ONNX_TOLERANCE = 1e-3 # accepted difference with the PyTorch outputs (relative and absolute)
+
+_sessions = {} # (graph path, fingerprint, threads) -> InferenceSession, kept between the jobs of the daemon
+
+
+class RPNHeadGraph(nn.Module):
+    """The RPN head for a single feature map, as exported: (features, pooled support) -> (logits, box deltas)."""
+
+    def __init__(self, head):
+        super(RPNHeadGraph, self).__init__()
+        self.head = head
+
+    def forward(self, features, pooled_support):
+        logits, bbox_reg = self.head([features], pooled_support)
+        return logits[0], bbox_reg[0]
+
+
+class OnnxModule(nn.Module):
+    """Runs an exported graph with ONNX Runtime in place of a PyTorch module."""
+
+    def __init__(self, session):
+        super(OnnxModule, self).__init__()
+        self.session = session
+        self.input_names = [i.name for i in session.get_inputs()]
+
+    def run(self, *inputs):
+        feed = {
+            name: x.detach().cpu().contiguous().numpy()
+            for name, x in zip(self.input_names, inputs)
+        }
+        return [torch.from_numpy(output) for output in self.session.run(None, feed)]
+
+
+class OnnxBackbone(OnnxModule):
+
+    def __init__(self, session, out_channels):
+        super(OnnxBackbone, self).__init__(session)
+        self.out_channels = out_channels
+
+    def forward(self, x):
+        return self.run(x)[0]
+
+
+class OnnxRPNHead(OnnxModule):
+    """Same interface as RPNHead: the support pooling stays in PyTorch."""
+
+    def __init__(self, session, head):
+        super(OnnxRPNHead, self).__init__(session)
+        self.pool_support = head.pool_support
+
+    def forward(self, x, pooled_support):
+        logits = []
+        bbox_reg = []
+        for feature in x:
+            feature_logits, feature_bbox_reg = self.run(feature, pooled_support)
+            logits.append(feature_logits)
+            bbox_reg.append(feature_bbox_reg)
+        return logits, bbox_reg
+
+
+class OnnxBoxHead(OnnxModule):
+
+    def forward(self, x):
+        return self.run(x)[0]
+
+
+def onnx_paths(onnx_dir, model_path):
+    """
+    Returns the paths of the exported graphs and of the export record of a model.
+
+    Args:
+        onnx_dir (str): The folder of the exported models.
+        model_path (str): The path to the saved model weights.
+
+    Returns:
+        Tuple[dict, str]: The graph paths ("backbone", "rpn_head", "box_head") and the record (.json) path.
+    """
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    graphs = {graph: os.path.join(onnx_dir, f"{name}_{graph}.onnx") for graph in ("backbone", "rpn_head", "box_head")}
+    return graphs, os.path.join(onnx_dir, f"{name}_onnx.json")
+
+
+def sample_inputs(model):
+    """Inputs of the exported graphs, with the shapes of a resized line (128x2048) and of its RoIs."""
+    channels = model.backbone.out_channels
+    roi_size = model.roi_heads.box_roi_pool.output_size[0]
+    generator = torch.Generator().manual_seed(0)
+    return {
+        "backbone": (torch.rand(1, 3, 128, 2048, generator=generator),),
+        "rpn_head": (torch.rand(2, channels, 4, 64, generator=generator), torch.rand(2, channels, 1, 1, generator=generator)),
+        "box_head": (torch.rand(16, channels, roi_size, roi_size, generator=generator),),
+    }
+
+
+def graph_modules(model):
+    """The PyTorch modules of the exported graphs, with their input/output names and dynamic axes."""
+    return {
+        "backbone": (model.backbone, ["images"], ["features"],
+                     {"images": {0: "batch", 2: "height", 3: "width"}, "features": {0: "batch", 2: "height", 3: "width"}}),
+        "rpn_head": (RPNHeadGraph(model.rpn.head), ["features", "pooled_support"], ["logits", "bbox_deltas"],
+                     {"features": {0: "batch", 2: "height", 3: "width"}, "pooled_support": {0: "supports"},
+                      "logits": {0: "batch", 2: "height", 3: "width"}, "bbox_deltas": {0: "batch", 2: "height", 3: "width"}}),
+        "box_head": (model.roi_heads.box_head, ["roi_features"], ["box_features"],
+                     {"roi_features": {0: "rois"}, "box_features": {0: "rois"}}),
+    }
+
+
+def create_session(onnxruntime, graph_path, threads):
+    """Creates an ONNX Runtime CPU session; "threads" is the number of intra-op threads (None: all cores)."""
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.inter_op_num_threads = 1
+    if threads is not None:
+        options.intra_op_num_threads = threads
+    return onnxruntime.InferenceSession(graph_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def export_model(onnxruntime, model, model_path, onnx_dir, threads):
+    """
+    Exports the graphs of a model and compares their outputs with the PyTorch modules on sample inputs.
+
+    Returns:
+        record (dict): The fingerprint of the exported model, the largest difference per graph
+            and whether the backend is enabled (all differences within ONNX_TOLERANCE).
+    """
+    graphs, record_path = onnx_paths(onnx_dir, model_path)
+    os.makedirs(onnx_dir, exist_ok=True)
+
+    inputs = sample_inputs(model)
+    record = {"model_fingerprint": model_fingerprint(model_path), "max_difference": {}, "enabled": True}
+
+    with torch.no_grad():
+        for graph, (module, input_names, output_names, dynamic_axes) in graph_modules(model).items():
+            torch.onnx.export(module, inputs[graph], graphs[graph], input_names=input_names, output_names=output_names,
+                              dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET)
+
+            expected = module(*inputs[graph])
+            expected = list(expected) if isinstance(expected, tuple) else [expected]
+            outputs = OnnxModule(create_session(onnxruntime, graphs[graph], threads)).run(*inputs[graph])
+
+            record["max_difference"][graph] = max(float((e - o).abs().max()) for e, o in zip(expected, outputs))
+            record["enabled"] = record["enabled"] and all(
+                np.allclose(o.numpy(), e.numpy(), rtol=ONNX_TOLERANCE, atol=ONNX_TOLERANCE) for e, o in zip(expected, outputs)
+            )
+
+    with open(record_path, "w") as f:
+        json.dump(record, f, indent=4)
+
+    return record
+
+
+def load_onnx_model(model, model_path, onnx_dir, threads=None, log_path=None):
+    """
+    Returns a Few-shot model whose backbone, RPN head and box head run with ONNX Runtime. The graphs are
+    exported on the first use of a model (or of a new version of it) and reused afterwards.
+
+    Args:
+        model (torch.nn.Module): The PyTorch model, on the CPU and in eval mode. It is not modified.
+        model_path (str): The path to the saved model weights.
+        onnx_dir (str): The folder of the exported models.
+        threads (int, optional): The number of ONNX Runtime threads. None: all cores.
+        log_path (str, optional): The log file, where the export and the fallback are reported.
+
+    Returns:
+        model (torch.nn.Module): The model with the ONNX Runtime modules, or the given model if the backend
+            cannot be used.
+    """
+    start_time = time.time()
+
+    try:
+        import onnxruntime
+
+        graphs, record_path = onnx_paths(onnx_dir, model_path)
+        fingerprint = model_fingerprint(model_path)
+
+        record = None
+        if os.path.isfile(record_path) and all(os.path.isfile(path) for path in graphs.values()):
+            with open(record_path, "r") as f:
+                record = json.load(f)
+        if record is None or record.get("model_fingerprint") != fingerprint:
+            record = export_model(onnxruntime, model, model_path, onnx_dir, threads)
+            log(log_path, 'ONNX export of {} in {:.2f} s, largest difference with PyTorch: {}'.format(model_path, time.time() - start_time, record["max_difference"]))
+
+        if not record["enabled"]:
+            log(log_path, 'ONNX outputs of {} are not within the tolerance, using PyTorch'.format(model_path))
+            return model
+
+        sessions = {}
+        for graph, graph_path in graphs.items():
+            key = (os.path.abspath(graph_path), fingerprint, threads)
+            if key not in _sessions:
+                _sessions[key] = create_session(onnxruntime, graph_path, threads)
+            sessions[graph] = _sessions[key]
+
+    except Exception as e:
+        log(log_path, 'ONNX Runtime backend not available ({}: {}), using PyTorch'.format(type(e).__name__, e))
+        return model
+
+    # shallow copies with their own submodules, so that a (cached) PyTorch model is left as it is
+    rpn = copy.copy(model.rpn)
+    rpn._modules = copy.copy(model.rpn._modules)
+    rpn.head = OnnxRPNHead(sessions["rpn_head"], model.rpn.head)
+
+    roi_heads = copy.copy(model.roi_heads)
+    roi_heads._modules = copy.copy(model.roi_heads._modules)
+    roi_heads.box_head = OnnxBoxHead(sessions["box_head"])
+
+    onnx_model = copy.copy(model)
+    onnx_model._modules = copy.copy(model._modules)
+    onnx_model.backbone = OnnxBackbone(sessions["backbone"], model.backbone.out_channels)
+    onnx_model.rpn = rpn
+    onnx_model.roi_heads = roi_heads
+
+    log(log_path, 'Using the ONNX Runtime backend for {}'.format(model_path))
+
+    return onnx_model
+
+
+def log(log_path, message):
+    if log_path is None:
+        return
+
+    with open(log_path, "a") as file:
+        file.write('{} {} \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), message))
@@ -0,0 +1,127 @@
+# ************************************************************************************************************
+# Int8 variant of a Few-shot model for CPU prediction. The convolutions of the VGG16 backbone (nearly all of
+# the compute) are quantized statically: conv+relu pairs are fused and the activation ranges are calibrated on
+# line and alphabet images. The linear layers of the heads (TwoMLPHead 25088->512->512, FastRCNNPredictor)
+# are quantized dynamically. The small RPN convolutions stay in fp32.
+#
+# A quantized model is produced from a user model with quantize_model.py, which also compares its CER with
+# the fp32 model on held-out lines. The prediction only uses it (on CPU) if that check enabled it, and only as
+# long as the fp32 model file is unchanged.
+#
+# ************************************************************************************************************
+
+import os
+import json
+import torch
+from torch import nn
+from few_shot_train.support_bank import model_fingerprint
+
+QUANTIZED_SUFFIX = "_int8" # the quantized model of "<model>.pth" is "<quantized dir>/<model>_int8.pth"
+
+
+class QuantizedBackbone(nn.Module):
+    """
+    The backbone with the conversion of its input to int8 and of its output back to float, so
+    that the rest of the model is unchanged.
+    """
+
+    def __init__(self, features, out_channels):
+        super(QuantizedBackbone, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.features = features
+        self.dequant = torch.quantization.DeQuantStub()
+        self.out_channels = out_channels
+
+    def forward(self, x):
+        return self.dequant(self.features(self.quant(x)))
+
+
+def prepare_model(model):
+    """
+    Fuses the conv+relu pairs of the backbone and adds the observers of the static quantization.
+    The model is then calibrated by running it on samples (see calibrate).
+
+    Args:
+        model (torch.nn.Module): The fp32 Few-shot model, on the CPU. Modified in place.
+
+    Returns:
+        model (torch.nn.Module): The prepared model.
+    """
+    model.eval()
+
+    features = model.backbone
+    conv_relu_pairs = [
+        [str(i), str(i + 1)] for i in range(len(features) - 1)
+        if isinstance(features[i], nn.Conv2d) and isinstance(features[i + 1], nn.ReLU)
+    ]
+    backbone = QuantizedBackbone(torch.quantization.fuse_modules(features, conv_relu_pairs), features.out_channels)
+    backbone.qconfig = torch.quantization.get_default_qconfig(torch.backends.quantized.engine)
+    torch.quantization.prepare(backbone, inplace=True)
+
+    model.backbone = backbone
+    return model
+
+
+def calibrate(model, lines, supports):
+    """
+    Records the activation ranges of the backbone on line and alphabet images.
+
+    Args:
+        model (torch.nn.Module): The prepared model (see prepare_model).
+        lines (list[Tensor]): Line images, as given to the model.
+        supports (list[Tensor]): Alphabet images, as given to the model.
+    """
+    with torch.no_grad():
+        for img in lines:
+            model.encode([img])
+        for img in supports:
+            model.encode_support([img])
+
+
+def convert_model(model):
+    """
+    Converts a prepared (and calibrated) model to int8: static backbone, dynamic linear layers.
+
+    Args:
+        model (torch.nn.Module): The prepared model (see prepare_model).
+
+    Returns:
+        model (torch.nn.Module): The quantized model, for the CPU only.
+    """
+    torch.quantization.convert(model.backbone, inplace=True)
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_architecture(model):
+    """Turns an fp32 model into the structure of its quantized variant, so that saved int8 weights can be loaded into it."""
+    return convert_model(prepare_model(model))
+
+
+def quantized_paths(quantized_dir, model_path):
+    """
+    Returns the paths of the quantized weights and of the accuracy check record of a model.
+
+    Args:
+        quantized_dir (str): The folder of the quantized models.
+        model_path (str): The path to the saved fp32 model weights.
+
+    Returns:
+        Tuple[str, str]: The weights (.pth) and record (.json) paths.
+    """
+    name = os.path.splitext(os.path.basename(model_path))[0] + QUANTIZED_SUFFIX
+    return os.path.join(quantized_dir, f"{name}.pth"), os.path.join(quantized_dir, f"{name}.json")
+
+
+def is_enabled(quantized_dir, model_path):
+    """
+    Checks whether the quantized variant of a model may be used: it exists, its accuracy check
+    enabled it, and it was produced from the current version of the fp32 model.
+    """
+    weights_path, record_path = quantized_paths(quantized_dir, model_path)
+    if not (os.path.isfile(weights_path) and os.path.isfile(record_path)):
+        return False
+
+    with open(record_path, "r") as f:
+        record = json.load(f)
+
+    return bool(record.get("enabled")) and record.get("model_fingerprint") == model_fingerprint(model_path)
@@ -0,0 +1,119 @@
+# ************************************************************************************************************
+# Produces the int8 variant of a Few-shot model for CPU prediction (see quantization.py) and checks its
+# accuracy: the CER of the int8 and of the fp32 model are compared on held-out lines (same shots for both).
+# The int8 model is enabled for the prediction only if its CER is at most "--max_cer_increase" higher.
+#
+# The data folder has the layout of the validation data of the fine-tuning: "lines/<cipher>/*.jpg" and
+# "gt/<cipher>/*.txt". A few of its lines ("--calibration_lines") are used for the calibration together with
+# the alphabet images, the others for the accuracy check. Paths are relative to this folder, e.g.:
+#   python quantize_model.py --model_path ../user_models/borg.pth --cipher borg --data_path <validation data>
+#
+# ************************************************************************************************************
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import torch
+from PIL import Image
+from torchvision.transforms import functional as Fsupp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import few_shot_train.htr_utils as htr_utils
+import few_shot_train.quantization as quantization
+from few_shot_train.test import init_model
+from few_shot_train.train import get_gt
+from few_shot_train.support_bank import SupportFeatureBank, model_fingerprint
+
+
+def load_line(lines_path, cipher, line_name, resizing):
+    img = Image.open(os.path.join(lines_path, cipher, line_name)).convert("RGB")
+    if resizing:
+        img = img.resize((2048,128))
+    return Fsupp.to_tensor(img)
+
+
+def character_error_rate(model, args, list_lines, lines_path, text_path, log_path):
+    """Few-shot prediction of the held-out lines, with the shots selected by "args.seed"."""
+    results = htr_utils.draw_and_read(model, torch.device('cpu'), args.alphabet_path, args.resize, args.threshold, list_lines, lines_path, args.cipher, args.shots, log_path, seed=args.seed)
+    gt = get_gt(list_lines, text_path, args.cipher, args.alphabet_path)
+    predictions = htr_utils.zid_read(args.threshold, results)[0]
+    return htr_utils.get_error_rate(gt, predictions)[0]
+
+
+def main():
+
+    # ! change working dir to the one containing this code
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, help='path to the fp32 model weights', required=True)
+    parser.add_argument('--cipher', type=str, help='name of the alphabet', required=True)
+    parser.add_argument('--data_path', type=str, help='held-out data: lines/<cipher>/ and gt/<cipher>/', required=True)
+    parser.add_argument('--alphabet_path', type=str, help='path to the alphabets', default='alphabet')
+    parser.add_argument('--resize', action='store_true', help='the model uses the new resizing')
+    parser.add_argument('--shots', type=int, help='number of shots', default=5)
+    parser.add_argument('--threshold', type=float, help='threshold of the prediction', default=0.4)
+    parser.add_argument('--calibration_lines', type=int, help='number of lines used for the calibration', default=10)
+    parser.add_argument('--max_cer_increase', type=float, help='highest accepted CER increase of the int8 model', default=0.01)
+    parser.add_argument('--output_dir', type=str, help='folder of the quantized models', default='../quantized_models')
+    parser.add_argument('--seed', type=int, help='seed of the line split and of the shots', default=0)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    device = torch.device('cpu')
+
+    weights_path, record_path = quantization.quantized_paths(args.output_dir, args.model_path)
+    os.makedirs(args.output_dir, exist_ok=True)
+    log_path = os.path.splitext(record_path)[0] + ".log"
+
+    lines_path = os.path.join(args.data_path, 'lines/')
+    text_path = os.path.join(args.data_path, 'gt/')
+
+    list_lines = sorted(os.listdir(os.path.join(lines_path, args.cipher)))
+    random.Random(args.seed).shuffle(list_lines)
+    calibration_lines = list_lines[:args.calibration_lines]
+    held_out_lines = list_lines[args.calibration_lines:]
+    if len(held_out_lines) == 0:
+        raise ValueError("no held-out lines left for the accuracy check, lower --calibration_lines")
+
+    # calibration: some lines and one image of every symbol
+    model = init_model(device, args.model_path, log_path)
+    support_bank = SupportFeatureBank(model, device, args.alphabet_path, args.cipher, args.resize)
+    supports = [support_bank.image(symbol, support_bank.alphabet.images[symbol][0]) for symbol in support_bank.alphabet.symbols]
+    lines = [load_line(lines_path, args.cipher, t, args.resize) for t in calibration_lines]
+
+    quantized_model = quantization.prepare_model(init_model(device, args.model_path))
+    quantization.calibrate(quantized_model, lines, supports)
+    quantized_model = quantization.convert_model(quantized_model)
+
+    # accuracy check on the held-out lines
+    start_time = time.time()
+    fp32_cer = character_error_rate(model, args, held_out_lines, lines_path, text_path, log_path)
+    fp32_time = time.time() - start_time
+
+    start_time = time.time()
+    int8_cer = character_error_rate(quantized_model, args, held_out_lines, lines_path, text_path, log_path)
+    int8_time = time.time() - start_time
+
+    record = {
+        "model_fingerprint": model_fingerprint(args.model_path),
+        "held_out_lines": len(held_out_lines),
+        "fp32_cer": fp32_cer,
+        "int8_cer": int8_cer,
+        "fp32_seconds": fp32_time,
+        "int8_seconds": int8_time,
+        "enabled": int8_cer <= fp32_cer + args.max_cer_increase,
+    }
+
+    torch.save(quantized_model.state_dict(), weights_path)
+    with open(record_path, "w") as f:
+        json.dump(record, f, indent=4)
+
+    print(json.dumps(record, indent=4))
+
+if __name__ == "__main__":
+    main()
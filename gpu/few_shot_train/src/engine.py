@@ -10,23 +10,40 @@ from few_shot_train.src.coco_eval import CocoEvaluator
 # import src.utils
 import few_shot_train.utils as utils
 
-def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq, log_path):
+def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq, log_path, accumulation_steps=1):
+    """
+    Trains the model for one epoch. With "accumulation_steps" > 1, the gradients of that many batches are
+    accumulated before every optimizer step (an effective batch size of accumulation_steps x batch size).
+    The throughput of the epoch (samples/s and share of the time spent waiting for the data loader) is
+    appended to the log file.
+    """
     model.train()
     metric_logger = utils.MetricLogger(log_path, delimiter="  ", device=device)
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}', device=device))
     header = 'Epoch: [{}]'.format(epoch)
 
+    steps = math.ceil(len(data_loader) / accumulation_steps)
+
     lr_scheduler = None
     if epoch == 0:
         warmup_factor = 1. / 1000
-        warmup_iters = min(1000, len(data_loader) - 1)
+        warmup_iters = min(1000, steps - 1)
 
         lr_scheduler = utils.warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor)
 
-    for images, supp_images, targets in metric_logger.log_every(data_loader, print_freq, header):
-        images = list(image.to(device) for image in images)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-        supp_images = list(supp_images.to(device) for supp_images in supp_images)
+    start_time = time.time()
+    data_time = 0
+    samples = 0
+    end = time.time()
+
+    optimizer.zero_grad()
+    for i, (images, supp_images, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        data_time += time.time() - end
+        samples += len(images)
+
+        images = list(image.to(device, non_blocking=True) for image in images)
+        targets = [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in targets]
+        supp_images = list(supp_images.to(device, non_blocking=True) for supp_images in supp_images)
         loss_dict = model(images,supp_images, targets)
 
         losses = sum(loss for loss in loss_dict.values())
@@ -42,16 +59,27 @@ def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq, lo
             print(loss_dict_reduced)
             sys.exit(1)
 
-        optimizer.zero_grad()
-        losses.backward()
-        optimizer.step()
+        (losses / accumulation_steps).backward()
 
-        if lr_scheduler is not None:
-            lr_scheduler.step()
+        if (i + 1) % accumulation_steps == 0 or i + 1 == len(data_loader):
+            optimizer.step()
+            optimizer.zero_grad()
+
+            if lr_scheduler is not None:
+                lr_scheduler.step()
 
         metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
+        end = time.time()
+
+    epoch_time = time.time() - start_time
+    with open(log_path, "a") as file:
+        file.write('{} Throughput: {:.2f} samples/s ({} samples in {:.2f} s), waiting for data {:.0%} of the time \n'.format(
+            time.strftime("%Y.%m.%d-%H.%M.%S"), samples / epoch_time, samples, epoch_time, data_time / epoch_time))
+
+    return metric_logger
+
 
 def _get_iou_types(model):
     model_without_ddp = model
@@ -5,6 +5,7 @@ Implements the Generalized R-CNN framework
 from collections import OrderedDict
 import torch
 from torch import nn
+from torchvision.models.detection.image_list import ImageList
 
 
 class GeneralizedRCNN(nn.Module):
@@ -27,44 +28,67 @@ class GeneralizedRCNN(nn.Module):
         self.rpn = rpn
         self.roi_heads = roi_heads
 
-    def forward(self, images,support, targets=None):
+    def encode(self, images, targets=None):
         """
+        Runs the transform and the backbone on a list of images.
+
         Arguments:
             images (list[Tensor]): images to be processed
             targets (list[Dict[Tensor]]): ground-truth boxes present in the image (optional)
 
         Returns:
-            result (list[BoxList] or dict[Tensor]): the output from the model.
-                During training, it returns a dict[Tensor] which contains the losses.
-                During testing, it returns list[BoxList] contains additional fields
-                like `scores`, `labels` and `mask` (for Mask R-CNN models).
-
+            images (ImageList): the transformed images
+            features (OrderedDict[Tensor]): the backbone feature maps of the images
+            targets (list[Dict[Tensor]]): the targets rescaled together with the images
         """
-        if self.training and targets is None:
-            raise ValueError("In training mode, targets should be passed")
-        original_image_sizes = [img.shape[-2:] for img in images]
-
-        
         images, targets = self.transform(images, targets)
-        # support = images
-        support ,whocares = self.transform(support,None)
-
-        
-
         features = self.backbone(images.tensors)
 
-        supp_features = self.backbone(support.tensors)
-        
         if isinstance(features, torch.Tensor):
             features = OrderedDict([(0, features)])
-        
-        if isinstance(supp_features, torch.Tensor):
-            supp_features = OrderedDict([(0, supp_features)])
-        
-        proposals, proposal_losses = self.rpn(images, features,supp_features, targets)
+
+        return images, features, targets
+
+    def encode_support(self, support):
+        """
+        Encodes support (alphabet symbol) images into everything the RPN and the RoI heads consume.
+        The result only depends on the model weights and the support images, so it can be reused
+        for any number of lines and cached between jobs (see support_bank.py).
+
+        Arguments:
+            support (list[Tensor]): support images to be processed
+
+        Returns:
+            support (Dict[Tensor]): with the fields
+                - features (OrderedDict[Tensor]): the backbone feature maps, used by the RoI heads
+                - image_sizes (list[Tuple[int, int]]): the support sizes after the transform
+                - pooled (Tensor[N, C, 1, 1]): the spatially pooled features, used by the RPN head
+        """
+        support, supp_features, _ = self.encode(support)
+
+        return dict(
+            features=supp_features,
+            image_sizes=support.image_sizes,
+            pooled=self.rpn.head.pool_support(supp_features),
+        )
+
+    def forward_encoded(self, images, features, support, original_image_sizes, targets=None):
+        """
+        Runs the RPN and the RoI heads on an already encoded line and support. The same
+        line features can be reused for any number of supports, which avoids running the
+        backbone on the same line again for every alphabet symbol.
+
+        Arguments:
+            images (ImageList): the transformed line images, as returned by encode
+            features (OrderedDict[Tensor]): the backbone features of the line images
+            support (Dict[Tensor]): the support embedding, as returned by encode_support
+            original_image_sizes (list[Tuple[int, int]]): the line sizes before the transform
+            targets (list[Dict[Tensor]]): the transformed targets (optional)
+        """
+        proposals, proposal_losses = self.rpn(images, features,support, targets)
 
         
-        detections, detector_losses = self.roi_heads(features,supp_features,proposals, images.image_sizes,support.image_sizes,targets)
+        detections, detector_losses = self.roi_heads(features,support,proposals, images.image_sizes,targets)
         detections = self.transform.postprocess(detections, images.image_sizes, original_image_sizes)
 
         losses = {}
@@ -75,3 +99,84 @@ class GeneralizedRCNN(nn.Module):
             return losses
 
         return detections
+
+    def forward_pairs(self, images, features, support, line_indices, original_image_sizes):
+        """
+        Scores line/support pairs in a single pass (inference only). Several lines can be encoded
+        together (see encode) and every line can be paired with any number of supports, e.g. one
+        line with all alphabet symbols, or a bucket of lines with their own selection of symbols.
+
+        Arguments:
+            images (ImageList): the transformed lines, as returned by encode
+            features (OrderedDict[Tensor]): the backbone features of the lines
+            support (Dict[Tensor]): the support embeddings of the pairs, stacked along the batch
+                dimension (see stack_supports in support_bank.py)
+            line_indices (list[int]): the index of the line (in images) of every pair
+            original_image_sizes (list[Tuple[int, int]]): the line sizes before the transform
+
+        Returns:
+            detections (list[Dict[Tensor]]): the detections of every pair, in the coordinates of its line
+        """
+        index = torch.as_tensor(line_indices, dtype=torch.int64, device=images.tensors.device)
+        pair_images = ImageList(images.tensors, [images.image_sizes[i] for i in line_indices])
+        pair_features = OrderedDict((k, v.index_select(0, index)) for k, v in features.items())
+
+        return self.forward_encoded(pair_images, pair_features, support, [original_image_sizes[i] for i in line_indices])
+
+    def propose(self, images, features, pooled_support):
+        """
+        Runs the RPN alone (inference only), conditioned on a given pooled support vector per line,
+        e.g. the mean of the supports of an alphabet, so that one proposal set serves all of them.
+
+        Arguments:
+            images (ImageList): the transformed lines, as returned by encode
+            features (OrderedDict[Tensor]): the backbone features of the lines
+            pooled_support (Tensor[N, C, 1, 1]): the vector the features of every line are conditioned on
+
+        Returns:
+            proposals (list[Tensor[K, 4]]): the proposals of every line
+        """
+        proposals, _ = self.rpn(images, features, dict(pooled=pooled_support))
+        return proposals
+
+    def forward_proposals(self, images, features, support, line_indices, original_image_sizes, proposals):
+        """
+        Scores line/support pairs like forward_pairs, but on the given proposals of the lines (see
+        propose) instead of running the RPN for every pair (inference only).
+
+        Arguments:
+            images (ImageList): the transformed lines, as returned by encode
+            features (OrderedDict[Tensor]): the backbone features of the lines
+            support (Dict[Tensor]): the support embeddings of the pairs, stacked along the batch dimension
+            line_indices (list[int]): the index of the line (in images) of every pair
+            original_image_sizes (list[Tuple[int, int]]): the line sizes before the transform
+            proposals (list[Tensor[K, 4]]): the proposals of every line
+
+        Returns:
+            detections (list[Dict[Tensor]]): the detections of every pair, in the coordinates of its line
+        """
+        detections = self.roi_heads.score_proposals(features, support, proposals, images.image_sizes, line_indices)
+        return self.transform.postprocess(detections, [images.image_sizes[i] for i in line_indices],
+                                          [original_image_sizes[i] for i in line_indices])
+
+    def forward(self, images,support, targets=None):
+        """
+        Arguments:
+            images (list[Tensor]): images to be processed
+            targets (list[Dict[Tensor]]): ground-truth boxes present in the image (optional)
+
+        Returns:
+            result (list[BoxList] or dict[Tensor]): the output from the model.
+                During training, it returns a dict[Tensor] which contains the losses.
+                During testing, it returns list[BoxList] contains additional fields
+                like `scores`, `labels` and `mask` (for Mask R-CNN models).
+
+        """
+        if self.training and targets is None:
+            raise ValueError("In training mode, targets should be passed")
+        original_image_sizes = [img.shape[-2:] for img in images]
+
+        images, features, targets = self.encode(images, targets)
+        support = self.encode_support(support)
+
+        return self.forward_encoded(images, features, support, original_image_sizes, targets)
@@ -1,4 +1,5 @@
 import torch
+from collections import OrderedDict
 
 import torch.nn.functional as F
 from torch import nn
@@ -553,12 +554,67 @@ class RoIHeads(torch.nn.Module):
 
         return all_boxes, all_scores, all_labels
 
-    def forward(self, features, supports, proposals, image_shapes,support_shapes, targets=None):
+    def pool_support(self, support):
+        """
+        RoI-pools every support image once. The support "proposal" is always the whole support
+        image, so its pooled feature is the same for all the proposals of the line it is paired
+        with, and it is broadcast against them instead of being pooled once per proposal.
+
+        Arguments:
+            support (Dict[Tensor]): the support embeddings, as returned by GeneralizedRCNN.encode_support
+
+        Returns:
+            box_support (Tensor[N, C, output_size, output_size]): one pooled feature per support image
+        """
+        support_shapes = support["image_sizes"]
+        sup_pro = []
+        for batch in range(len(support_shapes)):
+            support_proposals = torch.zeros((1,4))
+            support_proposals[:,2] = support_shapes[batch][0]
+            support_proposals[:,3] = support_shapes[batch][1]
+            sup_pro.append(support_proposals.to(self.device))
+
+        return self.box_roi_pool(support["features"], sup_pro, support_shapes)
+
+    def score_proposals(self, features, support, proposals, image_shapes, line_indices):
+        """
+        Scores line/support pairs on proposals that only depend on the line (inference only). The
+        RoI features of a line are pooled once and compared with every support it is paired with,
+        so the box head runs on the RoIs of all the pairs at once.
+
+        Arguments:
+            features (OrderedDict[Tensor]): the backbone features of the lines
+            support (Dict[Tensor]): the support embeddings of the pairs, stacked along the batch dimension
+            proposals (List[Tensor[N, 4]]): the proposals of every line
+            image_shapes (List[Tuple[H, W]]): the sizes of the transformed lines
+            line_indices (list[int]): the index of the line of every pair
+
+        Returns:
+            result (list[Dict[Tensor]]): the detections of every pair, in the coordinates of the transformed line
+        """
+        lines = sorted(set(line_indices))
+        index = torch.as_tensor(lines, dtype=torch.int64, device=proposals[0].device)
+        line_features = OrderedDict((k, v.index_select(0, index)) for k, v in features.items())
+        box_features = self.box_roi_pool(line_features, [proposals[i] for i in lines], [image_shapes[i] for i in lines])
+        box_features = dict(zip(lines, box_features.split([len(proposals[i]) for i in lines])))
+
+        box_support = self.pool_support(support)
+
+        box_merge = torch.cat([torch.abs(box_support[j:j+1] - box_features[i]) for j, i in enumerate(line_indices)])
+        class_logits, box_regression = self.box_predictor(self.box_head(box_merge))
+
+        boxes, scores, labels = self.postprocess_detections(class_logits, box_regression,
+                                                            [proposals[i] for i in line_indices], [image_shapes[i] for i in line_indices])
+
+        return [dict(boxes=b, labels=l, scores=s) for b, s, l in zip(boxes, scores, labels)]
+
+    def forward(self, features, support, proposals, image_shapes, targets=None):
         """
         Arguments:
             features (List[Tensor])
+            support (Dict[Tensor]): the support embedding, as returned by GeneralizedRCNN.encode_support
             proposals (List[Tensor[N, 4]])
-            image_shapes (List[Tuple[H, W]])support_shapes
+            image_shapes (List[Tuple[H, W]])
             targets (List[Dict])
         """
         if targets is not None:
@@ -572,26 +628,12 @@ class RoIHeads(torch.nn.Module):
             proposals, matched_idxs, labels, regression_targets = self.select_training_samples(proposals, targets)
         
         box_features = self.box_roi_pool(features, proposals, image_shapes)
-        
-        
-        
-        
-        sup_pro = []
-        # device = torch.device('cuda')
-        
 
-        for batch in range(len(proposals)):
-            support_proposals = torch.zeros((len(proposals[batch]),4))
-            support_proposals[:,2] = support_shapes[batch][0]#  224
-            support_proposals[:,3] = support_shapes[batch][1]#224    
-            sup_pro.append(support_proposals.to(self.device)) # 
-        
+        # one pooled support per image, broadcast over the proposals of the image
+        box_support = self.pool_support(support)
+        box_features = box_features.split([len(p) for p in proposals])
 
-        # print(supports, sup_pro, support_shapes)
-        box_support = self.box_roi_pool(supports, sup_pro, support_shapes)
-        # print(supports, sup_pro, support_shapes)
-        
-        box_merge = torch.abs(box_support - box_features) # torch.cat((box_support,box_features),1)#mul(box_support , box_features)#cat((box_support,box_features),0)
+        box_merge = torch.cat([torch.abs(box_support[batch:batch+1] - box_features[batch]) for batch in range(len(proposals))]) # torch.cat((box_support,box_features),1)#mul(box_support , box_features)#cat((box_support,box_features),0)
         box_merge = self.box_head(box_merge)
 
         # class_logits, box_regression = self.box_predictor(box_features,box_support)
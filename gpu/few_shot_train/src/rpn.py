@@ -156,13 +156,24 @@ class RPNHead(nn.Module):
             torch.nn.init.normal_(l.weight, std=0.01)
             torch.nn.init.constant_(l.bias, 0)
     
-    def forward(self, x,x_support):
+    def pool_support(self, x_support):
+        """
+        Spatially averages the support feature map into the vector that conditions the line features.
+
+        Arguments:
+            x_support (OrderedDict[Tensor]): the backbone features of the support images
+
+        Returns:
+            pooled_support (Tensor[N, C, 1, 1])
+        """
+        supp_feature = x_support[0]
+        return torch.mean(supp_feature,(2,3),keepdim=True)#avg_pooling(supp_feature)
+
+    def forward(self, x,pooled_support):
         logits = []
         bbox_reg = []
         for feature in x:
-            supp_feature = x_support[0]
-            supp_feature = torch.mean(supp_feature,(2,3),keepdim=True)#avg_pooling(supp_feature)
-            feature = torch.mul(feature,supp_feature)
+            feature = torch.mul(feature,pooled_support)
             t = F.relu(self.conv(feature))
             logits.append(self.cls_logits(t))
             bbox_reg.append(self.bbox_pred(t))
@@ -387,13 +398,15 @@ class RegionProposalNetwork(torch.nn.Module):
 
         return objectness_loss, box_loss
 
-    def forward(self, images, features,support_features, targets=None):
+    def forward(self, images, features,support, targets=None):
         """
         Arguments:
             images (ImageList): images for which we want to compute the predictions
             features (List[Tensor]): features computed from the images that are
                 used for computing the predictions. Each tensor in the list
                 correspond to different feature levels
+            support (Dict[Tensor]): the support embedding, as returned by
+                GeneralizedRCNN.encode_support. Only its `pooled` vector is used here.
             targets (List[Dict[Tensor]): ground-truth boxes present in the image (optional).
                 If provided, each element in the dict should contain a field `boxes`,
                 with the locations of the ground-truth boxes.
@@ -406,7 +419,7 @@ class RegionProposalNetwork(torch.nn.Module):
         """
         # RPN uses all feature maps that are available
         features = list(features.values())
-        objectness, pred_bbox_deltas = self.head(features,support_features)
+        objectness, pred_bbox_deltas = self.head(features,support["pooled"])
         anchors = self.anchor_generator(images, features)
 
         num_images = len(anchors)
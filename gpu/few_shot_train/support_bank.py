@@ -0,0 +1,292 @@
+# ************************************************************************************************************
+# Support-feature bank for Few-shot prediction. The support side of the model (alphabet symbol image ->
+# transform -> VGG16 backbone -> pooled vectors) only depends on the model weights, the alphabet image and
+# the resizing flag, so it is computed once and reused for every line of a job. If a cache folder is given,
+# the bank is also persisted on disk per model and alphabet, so that later jobs skip the support-side compute
+# entirely. The on-disk bank is invalidated whenever the model file (e.g. a fine-tuned model in user_models/)
+# changes.
+#
+# The alphabet images themselves are listed and decoded once per job (AlphabetBank), which also fixes the
+# symbol index and selects the shots of the lines.
+#
+# ************************************************************************************************************
+
+import os
+import io
+import random
+import hashlib
+import torch
+from PIL import Image
+from torchvision.transforms import functional as Fsupp
+
+
+def model_fingerprint(model_path):
+    """
+    Identifies a version of a model file without reading its (~500 MB) content.
+
+    Args:
+        model_path (str): The path to the saved model weights.
+
+    Returns:
+        str: A hash of the absolute path, size and modification time of the model file.
+    """
+    stat = os.stat(model_path)
+    identity = f"{os.path.abspath(model_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+
+def support_image_path(alphabet_path, cipher, symbol, symb):
+    """
+    Returns the path of an alphabet image. Some alphabets are nested one level deeper
+    (alphabet/<cipher>/<cipher>/<symbol>/), this is checked first.
+
+    Args:
+        alphabet_path (str): The path to the alphabets.
+        cipher (str): The name of the alphabet.
+        symbol (str): The name of the symbol (folder name).
+        symb (str): The file name of the image of the symbol.
+
+    Returns:
+        str: The path to the image.
+    """
+    nested_path = alphabet_path+'/'+cipher+'/'+cipher+'/'+symbol+'/'+symb.split('.png')[0]+'.jpg'
+    if os.path.isfile(nested_path):
+        return nested_path
+
+    return alphabet_path+'/'+cipher+'/'+symbol+'/'+symb.split('.jpg')[0]+'.jpg'
+
+
+def to_cpu(embedding):
+    """Moves every tensor of a support embedding to the CPU, so it can be saved and loaded on any device."""
+    return {
+        "features": type(embedding["features"])((k, v.cpu()) for k, v in embedding["features"].items()),
+        "image_sizes": [tuple(size) for size in embedding["image_sizes"]],
+        "pooled": embedding["pooled"].cpu(),
+    }
+
+
+def to_device(embedding, device):
+    """Moves every tensor of a support embedding to the given device."""
+    return {
+        "features": type(embedding["features"])((k, v.to(device)) for k, v in embedding["features"].items()),
+        "image_sizes": embedding["image_sizes"],
+        "pooled": embedding["pooled"].to(device),
+    }
+
+
+def stack_supports(embeddings):
+    """
+    Stacks support embeddings along the batch dimension, so that lines can be scored against
+    all of them in a single forward pass (see GeneralizedRCNN.forward_pairs).
+
+    Args:
+        embeddings (list[dict]): Support embeddings whose feature maps have the same shape.
+
+    Returns:
+        dict: The stacked support embedding.
+    """
+    features = embeddings[0]["features"]
+    return {
+        "features": type(features)((k, torch.cat([e["features"][k] for e in embeddings])) for k in features.keys()),
+        "image_sizes": [size for e in embeddings for size in e["image_sizes"]],
+        "pooled": torch.cat([e["pooled"] for e in embeddings]),
+    }
+
+
+class AlphabetBank(object):
+    """
+    The images of an alphabet for one job. The folders are listed once, and every image is read at
+    most once, so that selecting shots and scoring lines do not touch the disk again. An image is only
+    decoded into its support tensor when the tensor is needed: the support bank keys its embeddings by
+    the hash of the file content, so a cached embedding needs no decoding.
+
+    The symbol index (the rows of the Pro_matrix and the predicted integers, see inttosymbs) is the
+    order of the symbol folders as listed here. The images of a symbol are sorted, so that a seeded
+    selection of the shots gives the same images on every host.
+
+    Args:
+        alphabet_path (str): The path to the alphabets.
+        cipher (str): The name of the alphabet.
+        resizing (bool): Whether the model uses the new resizing (supports are resized to 128x128).
+    """
+
+    def __init__(self, alphabet_path, cipher, resizing):
+        self.alphabet_path = alphabet_path
+        self.cipher = cipher
+        self.resizing = resizing
+
+        self.symbols = os.listdir(alphabet_path+'/'+cipher)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.images = {symbol: sorted(os.listdir(alphabet_path+'/'+cipher+'/'+symbol)) for symbol in self.symbols}
+
+        self.tensors = {}
+        self.digests = {}
+        self.image_bytes = {} # read but not decoded yet, see load
+        self.sizes = {}
+
+    def select_shots(self, shots, rng=random):
+        """
+        Randomly selects the images (shots) of every symbol which a line is compared to.
+
+        Args:
+            shots (int): The number of images per symbol.
+            rng (random.Random): The random generator, the "random" module (global seed) by default.
+
+        Returns:
+            list[Tuple[str, list[str]]]: The symbols (in the order of the index) with their selected image file names.
+        """
+        selected_symbols = []
+        for symbol in self.symbols:
+            i_symbs = list(self.images[symbol])
+            rng.shuffle(i_symbs)
+            selected_symbols.append((symbol, i_symbs[:shots]))
+        return selected_symbols
+
+    def load_image(self, image_bytes):
+        """Decodes an alphabet image into the support tensor expected by the model."""
+        img2 = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        if self.resizing:
+            img2 = img2.resize((128,128))
+        return Fsupp.to_tensor(img2)
+
+    def load(self, symbol, symb):
+        """
+        Reads an alphabet image, unless it was already, and keeps the hash of its content and its size (from
+        the header). The image is only decoded by image(), its bytes are kept until then.
+        """
+        if (symbol, symb) not in self.digests:
+            with open(support_image_path(self.alphabet_path, self.cipher, symbol, symb), "rb") as f:
+                image_bytes = f.read()
+            self.digests[(symbol, symb)] = hashlib.sha1(image_bytes).digest()
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                self.sizes[(symbol, symb)] = img.size
+            self.image_bytes[(symbol, symb)] = image_bytes
+
+    def image(self, symbol, symb):
+        """
+        Returns the support tensor of an alphabet image, decoded on first use (a support embedding missing
+        from the bank, or a debug composite). It is shared, do not modify it.
+        """
+        if (symbol, symb) not in self.tensors:
+            self.load(symbol, symb)
+            self.tensors[(symbol, symb)] = self.load_image(self.image_bytes.pop((symbol, symb)))
+        return self.tensors[(symbol, symb)]
+
+    def size(self, symbol, symb):
+        """
+        Returns the (width, height) of an alphabet image as stored, before any resizing. Only the header of
+        an image that was not loaded yet is read, it is not decoded.
+        """
+        if (symbol, symb) not in self.sizes:
+            with Image.open(support_image_path(self.alphabet_path, self.cipher, symbol, symb)) as img:
+                self.sizes[(symbol, symb)] = img.size
+        return self.sizes[(symbol, symb)]
+
+    def digest(self, symbol, symb):
+        """Returns the hash of the content of an alphabet image."""
+        self.load(symbol, symb)
+        return self.digests[(symbol, symb)]
+
+
+class SupportFeatureBank(object):
+    """
+    Lazily computed support embeddings (see GeneralizedRCNN.encode_support) of the alphabet images.
+
+    Entries are keyed by a hash of (model fingerprint, alphabet image content, resizing flag). Without
+    a cache folder the bank only lives for the current job, otherwise it is loaded from and saved to
+    "<cache_path>/<model name>/<cipher>.pt".
+
+    Args:
+        model (torch.nn.Module): The Few-shot model, in eval mode.
+        device (torch.device): The device of the model.
+        alphabet_path (str): The path to the alphabets.
+        cipher (str): The name of the alphabet.
+        resizing (bool): Whether the model uses the new resizing (supports are resized to 128x128).
+        model_path (str, optional): The path to the saved model weights. Required for persistence.
+        cache_path (str, optional): The folder of the on-disk bank. No persistence if None.
+        alphabet (AlphabetBank, optional): The images of the alphabet, if they are already loaded.
+    """
+
+    def __init__(self, model, device, alphabet_path, cipher, resizing, model_path=None, cache_path=None, alphabet=None):
+        self.model = model
+        self.device = device
+        self.alphabet_path = alphabet_path
+        self.cipher = cipher
+        self.resizing = resizing
+        self.alphabet = alphabet if alphabet is not None else AlphabetBank(alphabet_path, cipher, resizing)
+
+        self.fingerprint = model_fingerprint(model_path) if model_path is not None else ""
+        self.bank_path = None
+        if cache_path is not None and model_path is not None:
+            model_name = os.path.splitext(os.path.basename(model_path))[0]
+            self.bank_path = os.path.join(cache_path, model_name, f"{cipher}.pt")
+
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+        self.load()
+
+    def load(self):
+        """Loads the on-disk bank, unless it is missing or was built with another version of the model."""
+        if self.bank_path is None or not os.path.isfile(self.bank_path):
+            return
+
+        try:
+            stored = torch.load(self.bank_path, map_location='cpu')
+        except Exception:
+            # a corrupt bank is simply rebuilt
+            return
+
+        if stored.get("model_fingerprint") == self.fingerprint:
+            self.entries = {key: to_device(embedding, self.device) for key, embedding in stored["entries"].items()}
+
+    def save(self):
+        """Writes the bank to disk (atomically) if new entries were computed."""
+        if self.bank_path is None or not self.dirty:
+            return
+
+        os.makedirs(os.path.dirname(self.bank_path), exist_ok=True)
+        tmp_path = f"{self.bank_path}.{os.getpid()}.tmp"
+        entries = {key: to_cpu(embedding) for key, embedding in self.entries.items()}
+        torch.save({"model_fingerprint": self.fingerprint, "entries": entries}, tmp_path)
+        os.replace(tmp_path, self.bank_path)
+        self.dirty = False
+
+    def key(self, image_digest):
+        """Hashes the inputs the support embedding depends on."""
+        h = hashlib.sha1()
+        h.update(self.fingerprint.encode("utf-8"))
+        h.update(image_digest)
+        h.update(b"resize" if self.resizing else b"no_resize")
+        return h.hexdigest()
+
+    def image(self, symbol, symb):
+        """Returns the support tensor of an alphabet image (e.g. for visualization)."""
+        return self.alphabet.image(symbol, symb)
+
+    def get(self, symbol, symb):
+        """
+        Returns the support embedding of an alphabet image, computing it on first use.
+
+        Args:
+            symbol (str): The name of the symbol (folder name).
+            symb (str): The file name of the image of the symbol.
+
+        Returns:
+            dict: The support embedding, on the device of the model. It is shared, do not modify it.
+        """
+        key = self.key(self.alphabet.digest(symbol, symb))
+
+        if key in self.entries:
+            self.hits += 1
+        else:
+            self.misses += 1
+            with torch.no_grad():
+                embedding = self.model.encode_support([self.alphabet.image(symbol, symb).to(self.device)])
+            self.entries[key] = embedding
+            self.dirty = True
+
+        return self.entries[key]
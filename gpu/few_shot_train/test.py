@@ -16,7 +16,12 @@ import torchvision
 import few_shot_train.src.transforms as T 
 
 import few_shot_train.htr_utils as htr_utils
-import traceback
+from few_shot_train.support_bank import SupportFeatureBank, AlphabetBank
+from few_shot_train.matrix_store import ScoreMatrixStore, STORED_THRESHOLD, apply_threshold
+from few_shot_train.checkpoint import load_checkpoint, log_load_time
+import few_shot_train.quantization as quantization
+import few_shot_train.onnx_backend as onnx_backend
+import traceback, time
 
 def get_transform(train):
     transforms = []
@@ -26,19 +31,19 @@ def get_transform(train):
     return T.Compose(transforms)
 
 
-def init_model(device, model_path):
+def build_model(device):
     """
-    Initialize a Few-shot model.
+    Builds the Few-shot model architecture, without loading any weights. The backbone is built
+    without the ImageNet weights, since all weights come from the checkpoint.
 
     Args:
         device (torch.device): The device to use for model computation. CPU or GPU.
-        model_path (str): The path to the saved model weights.
 
     Returns:
-        model (torch.nn.Module): The initialized Faster R-CNN model.
+        model (torch.nn.Module): The Faster R-CNN model.
     """
     num_classes = 2
-    backbone = torchvision.models.vgg16(pretrained=True, progress=False).features
+    backbone = torchvision.models.vgg16(pretrained=False, progress=False).features
     backbone.out_channels = 512
 
     anchor_generator = AnchorGenerator(sizes=((32, 64, 128, 256, 512),),
@@ -61,30 +66,155 @@ def init_model(device, model_path):
     model.roi_heads.box_predictor = FastRCNNPredictor(in_channels, num_classes)
     model.roi_heads.box_head = TwoMLPHead(in_channels2, in_channels)
 
-    model.load_state_dict(torch.load(model_path, map_location=device))
+    return model
+
+
+def init_model(device, model_path, log_path=None):
+    """
+    Initialize a Few-shot model.
+
+    Args:
+        device (torch.device): The device to use for model computation. CPU or GPU.
+        model_path (str): The path to the saved model weights.
+        log_path (str, optional): The log file, where the loading time is reported.
+
+    Returns:
+        model (torch.nn.Module): The initialized Faster R-CNN model.
+    """
+    start_time = time.time()
+
+    model = build_model(device)
+
+    state_dict, load_time = load_checkpoint(model_path)
+    model.load_state_dict(state_dict)
+    del state_dict
 
     model.to(device)
 
+    log_load_time(log_path, model_path, time.time() - start_time, load_time)
+
     return model
 
 
-def run_recognition(cipher, alphabet_path, SHOTS, THRESHOLD, READ_SPACES, data_path, model_path, log_path, resizing_flag, device):
+def init_quantized_model(device, quantized_model_path, log_path=None):
+    """
+    Initialize the int8 variant of a Few-shot model (see quantization.py), CPU only.
+
+    Args:
+        device (torch.device): Must be the CPU.
+        quantized_model_path (str): The path to the saved quantized model weights.
+        log_path (str, optional): The log file, where the loading time is reported.
+
+    Returns:
+        model (torch.nn.Module): The quantized Faster R-CNN model.
+    """
+    start_time = time.time()
+
+    model = quantization.quantize_architecture(build_model(device))
 
-    model = init_model(device, model_path)
+    state_dict, load_time = load_checkpoint(quantized_model_path)
+    model.load_state_dict(state_dict)
+    del state_dict
+
+    log_load_time(log_path, quantized_model_path, time.time() - start_time, load_time)
+
+    return model
+
+
+def run_recognition(cipher, alphabet_path, SHOTS, THRESHOLD, READ_SPACES, data_path, model_path, log_path, resizing_flag, device,
+                    support_cache_path=None, support_batch_size=None, line_batch_size=htr_utils.LINE_BATCH_SIZE,
+                    matrix_store_path=None, redecode_only=False, model_cache=None, quantized_model_dir=None,
+                    backend=onnx_backend.BACKEND_PYTORCH, onnx_model_dir=None, onnx_threads=None, cpu_workers=1, threads_per_worker=None,
+                    shots_seed=None, shared_proposals=False, line_mode=False, skip_blank=False, resize_buckets=None, adaptive_shots=False):
 
     draw_and_read = htr_utils.draw_and_read
     zid_read = htr_utils.zid_read
     inttosymbs = htr_utils.inttosymbs
     
+    # the ONNX Runtime backend (CPU only) runs the fp32 model, see onnx_backend.py
+    use_onnx = backend == onnx_backend.BACKEND_ONNX and device.type == 'cpu' and onnx_model_dir is not None
+
+    # on CPU, the int8 variant of the model is used if its accuracy check enabled it (see quantization.py)
+    load_model = init_model
+    if device.type == 'cpu' and not use_onnx and quantized_model_dir is not None and quantization.is_enabled(quantized_model_dir, model_path):
+        model_path, _ = quantization.quantized_paths(quantized_model_dir, model_path)
+        load_model = init_quantized_model
+        with open(log_path, "a") as file:
+            file.write('{} Using the int8 model {} \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), model_path))
+
     list_lines = sorted(os.listdir(os.path.join(data_path, cipher))) # gets the input lines
-    results = draw_and_read(model, device, alphabet_path, resizing_flag, THRESHOLD, list_lines, data_path,cipher,SHOTS, log_path) # Few-shot prediction
+    alphabet = AlphabetBank(alphabet_path, cipher, resizing_flag) # listed once, images are read on first use
+    line_paths = [os.path.join(data_path, cipher, t) for t in list_lines]
+
+    # score matrices of the lines, kept in "matrix_store_path" (if given) to decode them again with other settings
+    matrix_store = None
+    scoring_threshold = THRESHOLD
+    if matrix_store_path is not None:
+        # every option that changes the scores of a line is part of the key of its stored matrix
+        scoring_options = dict(line_mode=line_mode, skip_blank=skip_blank, resize_buckets=resize_buckets, adaptive_shots=adaptive_shots,
+                               shared_proposals=shared_proposals, shots_seed=shots_seed, onnx=use_onnx)
+        matrix_store = ScoreMatrixStore(matrix_store_path, model_path, cipher, SHOTS, resizing_flag, scoring_options)
+        scoring_threshold = STORED_THRESHOLD
+
+    results = [None] * len(list_lines)
+    if redecode_only and matrix_store is not None:
+        results = [matrix_store.load(line_path) for line_path in line_paths]
+
+    missing = [i for i, matrix in enumerate(results) if matrix is None]
+
+    if redecode_only:
+        with open(log_path, "a") as file:
+            file.write('{} Re-decoding: {} lines from stored score matrices, {} lines predicted \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), len(list_lines) - len(missing), len(missing)))
+
+    if len(missing) > 0:
+        # models are kept loaded between jobs if a cache is given (see few_shot_daemon.py)
+        if model_cache is not None:
+            model = model_cache.get(model_path, device, lambda device, model_path: load_model(device, model_path, log_path))
+        else:
+            model = load_model(device, model_path, log_path)
+        model.eval()
+
+        if use_onnx:
+            model = onnx_backend.load_onnx_model(model, model_path, onnx_model_dir, onnx_threads, log_path)
+            cpu_workers = 1 # the ONNX Runtime sessions cannot be shared with forked workers
+
+        # support features of the alphabet, persisted per model and alphabet if "support_cache_path" is given
+        support_bank = SupportFeatureBank(model, device, alphabet_path, cipher, resizing_flag, model_path, support_cache_path, alphabet)
+
+        matrices = draw_and_read(model, device, alphabet_path, resizing_flag, scoring_threshold, [list_lines[i] for i in missing], data_path,cipher,SHOTS, log_path, support_bank, support_batch_size, line_batch_size,
+                                 workers=cpu_workers, threads_per_worker=threads_per_worker, seed=shots_seed,
+                                 shared_proposals=shared_proposals, line_mode=line_mode, skip_blank=skip_blank,
+                                 resize_buckets=resize_buckets, adaptive_shots=adaptive_shots) # Few-shot prediction
+        support_bank.save()
+
+        with open(log_path, "a") as file:
+            file.write('{} Support features: {} computed, {} reused \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), support_bank.misses, support_bank.hits))
+
+        for i, matrix in zip(missing, matrices):
+            results[i] = matrix
+            if matrix_store is not None:
+                matrix_store.save(line_paths[i], matrix)
+
+        if matrix_store is not None:
+            removed = matrix_store.cleanup()
+            if removed > 0:
+                with open(log_path, "a") as file:
+                    file.write('{} Score matrices: {} least recently used removed from the store \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), removed))
+
+    if matrix_store is not None:
+        results = [apply_threshold(matrix, THRESHOLD) for matrix in results]
+
     predictions, pred_boxes  = zid_read(THRESHOLD, results, READ_SPACES) # Post-processing
-    pred_lines, fixed_alphabet = inttosymbs(alphabet_path, predictions, cipher) # Post-processing
+    pred_lines, fixed_alphabet = inttosymbs(alphabet_path, predictions, cipher, alphabet.symbols) # Post-processing
 
     return list_lines, pred_boxes, predictions, pred_lines, fixed_alphabet
 
 
-def main(cipher, alphabet_path, SHOTS, THRESHOLD, READ_SPACES, data_path, model_path, log_path, resizing_flag, device=torch.device('cpu')):
+def main(cipher, alphabet_path, SHOTS, THRESHOLD, READ_SPACES, data_path, model_path, log_path, resizing_flag, device=torch.device('cpu'),
+            support_cache_path=None, support_batch_size=None, line_batch_size=htr_utils.LINE_BATCH_SIZE,
+            matrix_store_path=None, redecode_only=False, model_cache=None, quantized_model_dir=None,
+            backend=onnx_backend.BACKEND_PYTORCH, onnx_model_dir=None, onnx_threads=None, cpu_workers=1, threads_per_worker=None,
+            shots_seed=None, shared_proposals=False, line_mode=False, skip_blank=False, resize_buckets=None, adaptive_shots=False):
 
     # ! change working dir to the one containing this code
     os.chdir(os.path.dirname(__file__))
@@ -98,7 +228,10 @@ def main(cipher, alphabet_path, SHOTS, THRESHOLD, READ_SPACES, data_path, model_
 
     try:
         list_lines, pred_boxes, predictions, pred_lines, fixed_alphabet = run_recognition(cipher,
-                alphabet_path, SHOTS, THRESHOLD, READ_SPACES, data_path, model_path, log_path, resizing_flag, device
+                alphabet_path, SHOTS, THRESHOLD, READ_SPACES, data_path, model_path, log_path, resizing_flag, device,
+                support_cache_path, support_batch_size, line_batch_size, matrix_store_path, redecode_only,
+                model_cache, quantized_model_dir, backend, onnx_model_dir, onnx_threads, cpu_workers, threads_per_worker,
+                shots_seed, shared_proposals, line_mode, skip_blank, resize_buckets, adaptive_shots
         )
         
     except:
@@ -1,11 +1,12 @@
 # ************************************************************************************************************
 # Few-shot training (or fine-tuning) code. We run the training on the data provided by the user on
 # the frontend. Takes as input symbols and their transcription, outputs the trained model weights.
-# Please note that you need a GPU to run this code.
+# Please note that you need a GPU to run this code, unless the backbone is frozen (see frozen_backbone.py).
 # 
 # ************************************************************************************************************
 
 import os
+import math
 import torch
 import torchvision
 from few_shot_train.src.faster_rcnn import FastRCNNPredictor, TwoMLPHead
@@ -16,9 +17,14 @@ import torchvision
 from few_shot_train.src.engine import train_one_epoch
 from few_shot_train.load_data import load_data
 import few_shot_train.htr_utils as htr_utils
+from few_shot_train.checkpoint import load_checkpoint, log_load_time, save_checkpoint
+from few_shot_train.validation import Validation
+from few_shot_train.frozen_backbone import FrozenBackboneModel, load_frozen_data
 
 import traceback, time
 
+MIN_IMPROVEMENT = 1e-3 # smallest decrease of the CER (or of the training loss) that counts as an improvement
+
 def get_gt(list_lines, val_text_path, cipher, alphabet_path):
     gt = []
     for x in list_lines[:]:
@@ -45,22 +51,26 @@ def txt_to_int(text, alphabet_path, cipher):
     return (res)
 
 
-def init_model(device, TRAIN_TYPE, model_path):
+def init_model(device, TRAIN_TYPE, model_path, log_path=None):
     """
-    Initialize the model for training.
+    Initialize the model for training. The ImageNet weights of the backbone are only loaded when training
+    from scratch, when fine-tuning all weights come from the checkpoint.
 
     Args:
         device (torch.device): The device to use for training. Can only be GPU.
         TRAIN_TYPE (str): The type of training ('fine_tune' or 'scratch'). We actually only use "fine_tune".
         model_path (str): The path to the pre-trained model weights.
+        log_path (str, optional): The log file, where the loading time is reported.
 
     Returns:
         model (torch.nn.Module): The initialized model.
         optimizer (torch.optim.Optimizer): The optimizer for training the model.
     """
+    start_time = time.time()
+
     num_classes = 2
 
-    backbone = torchvision.models.vgg16(pretrained=True).features
+    backbone = torchvision.models.vgg16(pretrained=(TRAIN_TYPE != 'fine_tune')).features
     backbone.out_channels = 512 
 
     anchor_generator = AnchorGenerator(sizes=((32, 64, 128, 256, 512),),
@@ -91,53 +101,83 @@ def init_model(device, TRAIN_TYPE, model_path):
                                 momentum=0.9, weight_decay=0.0005)
 
     if TRAIN_TYPE == 'fine_tune':
-        model.load_state_dict(torch.load(model_path, map_location=device))
+        state_dict, load_time = load_checkpoint(model_path)
+        model.load_state_dict(state_dict)
+        del state_dict
+
+        log_load_time(log_path, model_path, time.time() - start_time, load_time)
 
     return model, optimizer
 
 
-def run_train(user_validation_flag, resizing_flag, cipher, alphabet_path, BATCH_SIZE, SHOTS, THRESHOLD,
-                TRAIN_TYPE, root, val_data_path, number_of_epochs, model_path, new_model_path, log_path, lookup_table, device):
+def copy_state(model):
+    """A copy of the weights of the model on the CPU, which the rest of the training does not change."""
+    return {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
 
-    draw_and_read = htr_utils.draw_and_read
-    zid_read = htr_utils.zid_read
-    get_error_rate = htr_utils.get_error_rate
+
+def run_train(user_validation_flag, resizing_flag, cipher, alphabet_path, BATCH_SIZE, SHOTS, THRESHOLD,
+                TRAIN_TYPE, root, val_data_path, number_of_epochs, model_path, new_model_path, log_path, lookup_table, device,
+                validation_every=1, validation_lines=None, patience=0, frozen_backbone=False, frozen_layers=None,
+                accumulation_steps=1, loader_workers=4, persistent_workers=False, prefetch_factor=2, pin_memory=False):
 
     root_txt = os.path.join(root, 'annotation/train.txt')
     val_lines_path = os.path.join(val_data_path, 'lines/')
     val_text_path  = os.path.join(val_data_path, 'gt/')
 
-    model, optimizer = init_model(device, TRAIN_TYPE, model_path)
+    model, optimizer = init_model(device, TRAIN_TYPE, model_path, log_path)
 
     best_cer = 2 # ! has to be more than 1 because a training without validation set will produce a cer=1
-    dataset, data_loader = load_data(BATCH_SIZE,SHOTS,root, alphabet_path, cipher, resizing_flag, root_txt)
+    best_loss = math.inf
+    best_epoch = -1
+    best_state = None
+
+    # with a frozen backbone, the steps run on cached backbone features (see frozen_backbone.py)
+    if frozen_backbone:
+        dataset, data_loader = load_frozen_data(BATCH_SIZE,SHOTS, alphabet_path, cipher, resizing_flag, root_txt)
+        train_model = FrozenBackboneModel(model, dataset, device, frozen_layers, log_path)
+    else:
+        dataset, data_loader = load_data(BATCH_SIZE,SHOTS,root, alphabet_path, cipher, resizing_flag, root_txt,
+                                         num_workers=loader_workers, persistent_workers=persistent_workers, prefetch_factor=prefetch_factor,
+                                         pin_memory=pin_memory and device.type == 'cuda')
+        train_model = model
+
+    # validation lines, ground truth and alphabet are read once, see validation.py
+    validation = None
+    if user_validation_flag:
+        validation = Validation(device, alphabet_path, cipher, resizing_flag, THRESHOLD, SHOTS, val_lines_path, val_text_path, log_path,
+                                validation_every, validation_lines)
 
 
-    print_fr = int(len(dataset)/BATCH_SIZE/4)
+    print_fr = max(1, int(len(dataset)/BATCH_SIZE/4))
 
     accumulated_cer_log = "Character Error Rate (CER):\n"
 
+    # the CER of the model before the fine-tuning: the epochs have to improve on it, otherwise the model is saved unchanged
+    if frozen_backbone and validation is not None:
+        best_cer = validation.run(model)
+        best_state = copy_state(model)
+        cer_print = round(best_cer, 3)
+        with open(log_path,"a") as file:
+            file.write('Character Error Rate (CER) before fine-tuning:{} \n ------- \n'.format(cer_print))
+        accumulated_cer_log += f"Before fine-tuning - CER: {cer_print}\n"
+
     # training here
     for epoch in range(0, number_of_epochs):
 
         with open(log_path,"a") as file:
             file.write('{} Epoch: {}/{} \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), epoch+1, number_of_epochs))
 
-        train_one_epoch(model, optimizer, data_loader, device, epoch, print_fr, log_path)
+        metric_logger = train_one_epoch(train_model, optimizer, data_loader, device, epoch, print_fr, log_path, accumulation_steps)
 
-        # run validation if the user selected this option
-        # otherwise only save the model
-        if epoch >-1 and user_validation_flag:
-            
-            list_lines = os.listdir(os.path.join(val_lines_path, cipher))
+        # run validation if the user selected this option (every "validation_every" epochs)
+        # the best weights are kept in memory, the model is saved once at the end
+        if validation is not None:
+            if not validation.due(epoch, number_of_epochs):
+                continue
 
             # run Few-shot prediction on the validation data
-            results = draw_and_read(model, device, alphabet_path, resizing_flag, THRESHOLD, list_lines,val_lines_path,cipher,SHOTS, log_path)
-            gt = get_gt(list_lines, val_text_path, cipher, alphabet_path)
-            predictions  = zid_read(THRESHOLD, results)[0]
+            cer = validation.run(model)
 
-            cer = get_error_rate(gt, predictions)[0]
-            
             # log character error rate for the user
             with open(log_path,"a") as file:
                 cer_print = round(cer, 3)
@@ -145,11 +185,35 @@ def run_train(user_validation_flag, resizing_flag, cipher, alphabet_path, BATCH_
                 epoch_number = epoch+1
                 accumulated_cer_log += f"Epoch {epoch_number} - CER: {cer_print}\n"
 
-            if cer<best_cer:
+            if cer<best_cer - MIN_IMPROVEMENT or best_state is None:
                 best_cer = cer
-                torch.save(model.state_dict(), new_model_path)
+                best_epoch = epoch
+                best_state = copy_state(model)
+        else:
+            # without validation, the training loss decides which weights are kept and the early stopping
+            loss = metric_logger.loss.global_avg
+            if loss < best_loss - MIN_IMPROVEMENT:
+                best_loss = loss
+                best_epoch = epoch
+                best_state = copy_state(model)
+
+        # early stopping after "patience" epochs without improvement (0: all epochs are run)
+        if patience > 0 and epoch - best_epoch >= patience and epoch + 1 < number_of_epochs:
+            with open(log_path,"a") as file:
+                file.write('{} Early stopping: no improvement since epoch {} \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), best_epoch+1))
+            break
+
+    # no epoch run (or none improved on the model before the fine-tuning): the model is saved unchanged
+    if best_state is None:
+        best_state = model.state_dict()
+    save_checkpoint(best_state, new_model_path)
+
+    with open(log_path,"a") as file:
+        if best_epoch < 0:
+            saved = 'the weights before the fine-tuning'
         else:
-            torch.save(model.state_dict(), new_model_path)
+            saved = 'the weights of epoch {}/{} ({})'.format(best_epoch+1, number_of_epochs, 'best validation CER' if validation is not None else 'best training loss')
+        file.write('{} Saved {} to {} \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), saved, new_model_path))
 
     if user_validation_flag:
         lookup_table["cer"] = accumulated_cer_log # we just overwrite it
@@ -158,7 +222,8 @@ def run_train(user_validation_flag, resizing_flag, cipher, alphabet_path, BATCH_
 
 
 def main(user_validation_flag, resizing_flag, cipher, alphabet_path, BATCH_SIZE, SHOTS, THRESHOLD, TRAIN_TYPE, root, val_data_path, number_of_epochs,
-            model_path, new_model_path, log_path, lookup_table, device=torch.device('cpu')):
+            model_path, new_model_path, log_path, lookup_table, device=torch.device('cpu'), validation_every=1, validation_lines=None, patience=0,
+            frozen_backbone=False, frozen_layers=None, accumulation_steps=1, loader_workers=4, persistent_workers=False, prefetch_factor=2, pin_memory=False):
 
     # ! change working dir to the one containing this code
     os.chdir(os.path.dirname(__file__))
@@ -168,7 +233,8 @@ def main(user_validation_flag, resizing_flag, cipher, alphabet_path, BATCH_SIZE,
     try:
         lookup_table = run_train(user_validation_flag, resizing_flag, cipher, alphabet_path, BATCH_SIZE, SHOTS, THRESHOLD,
             TRAIN_TYPE, root, val_data_path, number_of_epochs, model_path, new_model_path,
-            log_path, lookup_table, device
+            log_path, lookup_table, device, validation_every, validation_lines, patience, frozen_backbone, frozen_layers,
+            accumulation_steps, loader_workers, persistent_workers, prefetch_factor, pin_memory
         )
         
     except:
@@ -0,0 +1,80 @@
+# ************************************************************************************************************
+# Validation of the Few-shot fine-tuning. The validation lines, their ground truth and the alphabet index are
+# read once per training; every validation scores the lines with the model being trained (batched lines, see
+# draw_and_read) and computes the support features of its shots once (in memory, the weights change between
+# epochs). The shots are seeded, so that the CER of two epochs only differs by the weights of the model.
+#
+# A validation can be run every "every" epochs (the last epoch is always validated) and on a fixed sample of
+# the validation lines.
+#
+# ************************************************************************************************************
+
+import os
+import time
+import random
+import torch
+import few_shot_train.htr_utils as htr_utils
+from few_shot_train.support_bank import AlphabetBank, SupportFeatureBank
+
+VALIDATION_SEED = 0 # seed of the sample of lines and of the shots
+
+
+class Validation(object):
+    """
+    Arguments:
+        device (torch.device): The device of the model.
+        alphabet_path (str): The path to the alphabets.
+        cipher (str): The name of the alphabet.
+        resizing (bool): Whether the model uses the new resizing.
+        threshold (float): The threshold of the prediction.
+        shots (int): The number of shots per symbol.
+        lines_path (str): The folder of the validation lines ("<lines_path>/<cipher>/*.jpg").
+        text_path (str): The folder of their ground truth ("<text_path>/<cipher>/*.txt").
+        log_path (str): The log file.
+        every (int): Validates every this many epochs.
+        max_lines (int, optional): Validates on a fixed random sample of this many lines. None: all lines.
+    """
+
+    def __init__(self, device, alphabet_path, cipher, resizing, threshold, shots, lines_path, text_path, log_path, every=1, max_lines=None):
+        self.device = device
+        self.alphabet_path = alphabet_path
+        self.cipher = cipher
+        self.resizing = resizing
+        self.threshold = threshold
+        self.shots = shots
+        self.lines_path = lines_path
+        self.log_path = log_path
+        self.every = max(1, every)
+
+        self.list_lines = sorted(os.listdir(os.path.join(lines_path, cipher)))
+        if max_lines is not None and 0 < max_lines < len(self.list_lines):
+            self.list_lines = sorted(random.Random(VALIDATION_SEED).sample(self.list_lines, max_lines))
+
+        # imported here, train.py uses this module
+        from few_shot_train.train import get_gt
+        self.gt = get_gt(self.list_lines, text_path, cipher, alphabet_path)
+        self.alphabet = AlphabetBank(alphabet_path, cipher, resizing)
+
+    def due(self, epoch, number_of_epochs):
+        """Whether the model is validated after the given epoch (0-based)."""
+        return (epoch + 1) % self.every == 0 or epoch + 1 == number_of_epochs
+
+    def run(self, model):
+        """
+        Returns the character error rate of the model on the validation lines. The model is left in eval mode.
+        """
+        start_time = time.time()
+
+        model.eval()
+        with torch.no_grad():
+            support_bank = SupportFeatureBank(model, self.device, self.alphabet_path, self.cipher, self.resizing, alphabet=self.alphabet)
+            results = htr_utils.draw_and_read(model, self.device, self.alphabet_path, self.resizing, self.threshold, self.list_lines,
+                                              self.lines_path, self.cipher, self.shots, self.log_path, support_bank, seed=VALIDATION_SEED)
+
+        predictions = htr_utils.zid_read(self.threshold, results)[0]
+        cer = htr_utils.get_error_rate(self.gt, predictions)[0]
+
+        with open(self.log_path, "a") as file:
+            file.write('{} Validation: {} lines in {:.2f} s \n'.format(time.strftime("%Y.%m.%d-%H.%M.%S"), len(self.list_lines), time.time() - start_time))
+
+        return cer
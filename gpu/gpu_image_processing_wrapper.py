@@ -41,9 +41,58 @@ def handle_exception(exc_type, exc_value, exc_traceback):
 
 sys.excepthook = handle_exception
 
+# the log file of the running job: a handler is attached for every job (see main), so that the jobs of the
+# resident daemon (few_shot_daemon.py) each log into their own file
+file_logger = logging.getLogger(__name__ + ".job")
+file_logger.propagate = False
+
 # ! this config is duplicated elsewhere in the code
 FLOAT_PRECISION = 3
 
+# Maximum number of alphabet images scored against a line in a single forward pass of the Few-shot prediction.
+# None: estimated from the available (GPU or CPU) memory.
+SUPPORT_BATCH_SIZE = None # TODO: change according to your GPU if the estimate does not fit your setup
+# Maximum number of lines encoded together in the Few-shot prediction (lines are batched with lines of similar width).
+LINE_BATCH_SIZE = 8 # TODO: change according to your GPU
+# Number of threads of the ONNX Runtime backend of the Few-shot prediction on CPU. None: all cores.
+ONNX_THREADS = None # TODO: change according to your CPU
+# Number of processes sharing the lines of a Few-shot prediction on CPU (1: a single process), and number of
+# PyTorch threads of every process (None: the cores are split evenly between the processes).
+CPU_WORKERS = 1 # TODO: change according to your CPU, e.g. 8 workers with 4 threads each on a 32-core server
+THREADS_PER_WORKER = None # TODO: change according to your CPU
+# Seed of the selection of the shots: a line is compared to the same alphabet images in every prediction.
+# None: new shots are drawn at random in every prediction.
+SHOTS_SEED = 0
+# Whether the Few-shot prediction generates the proposals of a line once for all alphabet images (conditioned on
+# their mean) instead of once per image. Faster, but the scores change slightly: check the accuracy on your data
+# with few_shot_train/benchmark.py --variant shared_proposals before enabling it.
+SHARED_PROPOSALS = False
+# Whether the Few-shot prediction only uses the anchors that fit the height of the lines and the shapes of the
+# alphabet symbols, with fewer proposals per line (see few_shot_train/line_anchors.py). Check the accuracy on your
+# data with few_shot_train/benchmark.py --variant line_mode before enabling it.
+LINE_MODE = False
+# Whether the Few-shot prediction skips the blank margins and long blank gaps of the lines (see
+# few_shot_train/ink_segments.py). Check the accuracy on your data with few_shot_train/benchmark.py --variant skip_blank.
+SKIP_BLANK = False
+# Widths the lines are padded to by the resizing models, keeping their aspect ratio (e.g. (512, 1024, 2048)).
+# None: every line is stretched to 2048x128. Check the accuracy on your data with few_shot_train/benchmark.py
+# --resize --variant resize_buckets before enabling it.
+RESIZE_WIDTH_BUCKETS = None
+# Whether the Few-shot prediction scores the shots of a symbol one after the other and stops once a shot no longer
+# changes its scores (see score_lines_adaptively in few_shot_train/htr_utils.py). Check the accuracy on your data
+# with few_shot_train/benchmark.py --variant adaptive_shots before enabling it.
+ADAPTIVE_SHOTS = False
+# Number of frozen layers at the start of the VGG16 backbone in the frozen-backbone fine-tuning (see
+# few_shot_train/frozen_backbone.py), e.g. 17 freezes the first three blocks. None: the whole backbone.
+FROZEN_BACKBONE_LAYERS = None
+# Data loading of the Few-shot fine-tuning (see few_shot_train/load_data.py): number of loader processes, whether
+# they are kept between epochs, batches loaded in advance by every process and pinned memory (GPU only). Size them
+# per host with the throughput logged after every epoch.
+TRAIN_LOADER_WORKERS = 4 # TODO: change according to your GPU/CPU
+TRAIN_PERSISTENT_WORKERS = True
+TRAIN_PREFETCH_FACTOR = 2 # TODO: change according to your GPU/CPU
+TRAIN_PIN_MEMORY = True
+
 def get_gpu_memory_map():
     # https://discuss.pytorch.org/t/access-gpu-memory-usage-in-pytorch/3192/3
     """Get the current gpu usage.
@@ -149,7 +198,7 @@ def append_to_filename(file_path, addition):
 
 
 def run_few_shot_test(current_code, additional_arguments, WORKING_DIR_PATH, LOG_PATH, session_id, BASE_MODELS_WITH_RESIZING,
-                        bounding_boxes_json, transcription_json, generated_transcription_json, device):
+                        bounding_boxes_json, transcription_json, generated_transcription_json, device, model_cache=None):
     """
     Runs the Few-shot prediction algorithm. First converts the input lines from the bounding_boxes_json format to
     the format (as images inside folders) required by the Few-shot code. Then runs the Few-shot code and converts the output back to the
@@ -166,6 +215,7 @@ def run_few_shot_test(current_code, additional_arguments, WORKING_DIR_PATH, LOG_
         transcription_json (dict): Contains the cluster_id to transcription mapping.
         generated_transcription_json (dict): The existing or previously predicted line-by-line transcription stored as json.
         device (str): The device to run the test on: CPU or GPU.
+        model_cache (ModelCache, optional): Keeps the models loaded between jobs (see few_shot_daemon.py).
     """
 
     SHOTS = additional_arguments["current_execution"]["numberOfShots"]
@@ -178,6 +228,12 @@ def run_few_shot_test(current_code, additional_arguments, WORKING_DIR_PATH, LOG_
     DATA_PATH = f"{WORKING_DIR_PATH}/{session_id}"
     CIPHER_PATH = f"{DATA_PATH}/{CIPHER}"
     MODEL_PATH = f"../user_models/{MODEL}.pth"
+    SUPPORT_CACHE_PATH = "../support_cache" # on-disk support-feature bank, rebuilt automatically if a model changes
+    MATRIX_STORE_PATH = f"{WORKING_DIR_PATH}/few_shot_matrices" # raw score matrices of the lines, to decode them again with another threshold or spaces setting
+    QUANTIZED_MODEL_DIR = "../quantized_models" # int8 variants of the models for CPU prediction, see few_shot_train/quantize_model.py
+    REDECODE_ONLY = additional_arguments["current_execution"].get("fewShotRedecodeOnly", 0) == 1 # only lines without stored matrices go through the network
+    ONNX_MODEL_DIR = "../onnx_models" # ONNX exports of the models, created on their first use with the ONNX Runtime backend
+    BACKEND = additional_arguments["current_execution"].get("fewShotBackend", "pytorch") # "pytorch" or "onnxruntime" (CPU only)
 
     RESIZING_FLAG = True if ("RESIZE_FLAG" in MODEL or MODEL in BASE_MODELS_WITH_RESIZING) else False
 
@@ -286,7 +342,10 @@ def run_few_shot_test(current_code, additional_arguments, WORKING_DIR_PATH, LOG_
     error_message, list_lines, pred_boxes, predictions, pred_lines, fixed_alphabet = current_code.main(
         CIPHER, ALPHABET_PATH, SHOTS, THRESHOLD, READ_SPACES,
         DATA_PATH, MODEL_PATH, LOG_PATH, RESIZING_FLAG,
-        device
+        device, SUPPORT_CACHE_PATH, SUPPORT_BATCH_SIZE, LINE_BATCH_SIZE,
+        MATRIX_STORE_PATH, REDECODE_ONLY, model_cache, QUANTIZED_MODEL_DIR,
+        BACKEND, ONNX_MODEL_DIR, ONNX_THREADS, CPU_WORKERS, THREADS_PER_WORKER,
+        SHOTS_SEED, SHARED_PROPOSALS, LINE_MODE, SKIP_BLANK, RESIZE_WIDTH_BUCKETS, ADAPTIVE_SHOTS
     )
 
     # If there was no warning, then we process the output of code by converting back its dataformat to ours.
@@ -425,8 +484,13 @@ def run_few_shot_train(current_code, additional_arguments, WORKING_DIR_PATH, LOG
     THRESHOLD = additional_arguments["current_execution"]["thresholdFewShots"]
     MODEL = additional_arguments["current_execution"]["selectedModelFewShots"] # existing model which will be fine-tuned
     NEW_MODEL = additional_arguments["current_execution"]["new_model_key"]
-    BATCH_SIZE = 3
+    BATCH_SIZE = additional_arguments["current_execution"].get("fewShotBatchSize", 3)
+    ACCUMULATION_STEPS = additional_arguments["current_execution"].get("fewShotGradientAccumulation", 1) # batches per optimizer step
     TRAIN_TYPE = "fine_tune" # there is currently no other option here
+    VALIDATION_EVERY = additional_arguments["current_execution"].get("fewShotValidationEvery", 1) # validates every this many epochs (and after the last one)
+    VALIDATION_LINES = additional_arguments["current_execution"].get("fewShotValidationLines", 0) or None # validates on a sample of this many lines, 0: all lines
+    PATIENCE = additional_arguments["current_execution"].get("fewShotPatience", 0) # stops after this many epochs without a better CER (or training loss), 0: never
+    FROZEN_BACKBONE = additional_arguments["current_execution"].get("fewShotFrozenBackbone", 0) == 1 # only the heads are trained, on cached backbone features
 
     RESIZING_FLAG = True if "RESIZE_FLAG" in NEW_MODEL else False
 
@@ -611,17 +675,27 @@ def run_few_shot_train(current_code, additional_arguments, WORKING_DIR_PATH, LOG
         CIPHER, ALPHABET_PATH, BATCH_SIZE, SHOTS, THRESHOLD, TRAIN_TYPE,
         DATA_PATH, VALIDATION_DATA_PATH, EPOCHS,
         MODEL_PATH, NEW_MODEL_PATH,
-        LOG_PATH, lookup_table, device
+        LOG_PATH, lookup_table, device,
+        VALIDATION_EVERY, VALIDATION_LINES, PATIENCE,
+        FROZEN_BACKBONE, FROZEN_BACKBONE_LAYERS,
+        ACCUMULATION_STEPS, TRAIN_LOADER_WORKERS, TRAIN_PERSISTENT_WORKERS, TRAIN_PREFETCH_FACTOR, TRAIN_PIN_MEMORY
     )
 
 
     return error_message, lookup_table
 
 
-def main():
+def main(argv=None, model_cache=None):
+    """
+    Runs a Few-shot job, called either as a script or by the resident daemon (few_shot_daemon.py).
+
+    Args:
+        argv (list, optional): The command line arguments, sys.argv[1:] if None.
+        model_cache (ModelCache, optional): Keeps the models loaded between jobs of the daemon.
+    """
 
     # ! change working dir to the one containing this code
-    os.chdir(os.path.dirname(__file__))
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--code', type=str, help='target python code', required=True)
@@ -635,7 +709,31 @@ def main():
     parser.add_argument('--working_dir', type=str, help='path to working directory', required=True) # where input/output files are/will be located
     parser.add_argument('--suffix', type=str, help='suffix appended to the end of output file names', required=True)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    LOG_PATH = os.path.join(args.working_dir, f"{args.sessionID}-log.txt")
+    file_handler = logging.FileHandler(LOG_PATH)
+    file_logger.addHandler(file_handler)
+    try:
+        run_job(args, LOG_PATH, model_cache)
+    except Exception:
+        # the output gets it from the exception hook (script) or from the daemon
+        file_logger.exception("Uncaught exception")
+        raise
+    finally:
+        file_logger.removeHandler(file_handler)
+        file_handler.close()
+
+
+def run_job(args, LOG_PATH, model_cache=None):
+    """
+    Runs the Few-shot job of the parsed command line arguments, see main.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+        LOG_PATH (str): The path to the log file.
+        model_cache (ModelCache, optional): Keeps the models loaded between jobs of the daemon.
+    """
 
     current_code = None
     minimum_required_gpu_memory = 0
@@ -692,9 +790,6 @@ def main():
 
     WORKING_DIR_PATH = args.working_dir # absolute path
 
-    LOG_PATH = os.path.join(WORKING_DIR_PATH, f"{session_id}-log.txt")
-    logging.basicConfig(filename=LOG_PATH)
-
     BASE_MODELS_WITH_RESIZING = ["cipherglot-mix", "cipherglot-separated"]
     BASE_MODELS_FOR_FINE_TUNING = execution_parameters["base_models"]
 
@@ -713,6 +808,8 @@ def main():
         # overall this seems like a risky business: to run multiple processes on a single gpu; this check is not a reliable way to avoid collisions
         memory_in_use_MB = get_gpu_memory_map()
         free_memory_MB = total_memory_MB - memory_in_use_MB[0] # applicable for a single GPU!
+        # memory already reserved by this process (e.g. models kept loaded by the daemon) is available to it
+        free_memory_MB += torch.cuda.memory_reserved(device) / 1024 / 1024
 
     # switch to cpu if gpu is not available (or out of memory)
     if not (free_memory_MB > minimum_required_gpu_memory and device == torch.device('cuda')):
@@ -740,13 +837,13 @@ def main():
 
         error_message, bounding_boxes_json, transcription_json, generated_transcription_json = run_few_shot_test(current_code,
                                         additional_arguments, WORKING_DIR_PATH, LOG_PATH, session_id, BASE_MODELS_WITH_RESIZING,
-                                        bounding_boxes_json, transcription_json, generated_transcription_json, device)
+                                        bounding_boxes_json, transcription_json, generated_transcription_json, device, model_cache)
 
             
     elif args.code == "train_few_shot.py":
             
-        # we cannot train on CPU since the trained models will not be usable later
-        if device != torch.device('cuda'):
+        # the whole model is only trained on GPU, on CPU only the heads can be fine-tuned (frozen backbone)
+        if device != torch.device('cuda') and execution_parameters.get("fewShotFrozenBackbone", 0) != 1:
             raise ValueError("****no GPU available for training, exiting...")
         else:
             error_message, lookup_table = run_few_shot_train(current_code, additional_arguments, WORKING_DIR_PATH, LOG_PATH, session_id,
@@ -763,7 +860,7 @@ def main():
             bounding_boxes_json["documents"][key].append(box)
 
     # ! change again working dir to the one containing this code, as we changed it in the Few-shot codes as well
-    os.chdir(os.path.dirname(__file__))
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
     # handle errors of called python code
     if error_message != None:
@@ -391,6 +391,8 @@ const executeBackendFewShotsPromise = () => {
     const selectedModelFewShots = $(`input[name="fewShotsModelRadio"]:checked`).val();
     const selected_model_user_given_name = document.querySelector("#fewShotsModelSelection input:checked ~ label").textContent;
     const fewShotReadSpacesBool = parseInt($(`input[name="fewShotReadSpaceBool"]:checked`).val());
+    const fewShotRedecodeOnly = parseInt($(`input[name="fewShotRedecodeOnly"]:checked`).val());
+    const fewShotBackend = $(`input[name="fewShotBackend"]:checked`).val();
     const numberOfShots = parseInt(document.querySelector("#numberOfShots").value);
     const thresholdFewShots = parseFloat(document.querySelector("#thresholdFewShots").value);
 
@@ -416,6 +418,8 @@ const executeBackendFewShotsPromise = () => {
         "selectedModelFewShots": selectedModelFewShots,
         "selected_model_user_given_name": selected_model_user_given_name,
         "fewShotReadSpacesBool": fewShotReadSpacesBool,
+        "fewShotRedecodeOnly": fewShotRedecodeOnly,
+        "fewShotBackend": fewShotBackend,
     };
 
     const payloadToServer = {
@@ -534,6 +538,12 @@ const execute_backend_few_shot_train_promise = () => {
     let few_shot_train_new_model_name = document.querySelector("#few_shot_train_new_model_name").value;
     const selected_model_user_given_name = document.querySelector("#few_shot_train_model_selection input:checked ~ label").textContent;
     const few_shot_train_epochs = parseInt(document.querySelector("#few_shot_train_epochs").value);
+    const fewShotFrozenBackbone = parseInt($(`input[name="fewShotFrozenBackbone"]:checked`).val());
+    const fewShotValidationEvery = parseInt(document.querySelector("#fewShotValidationEvery").value);
+    const fewShotValidationLines = parseInt(document.querySelector("#fewShotValidationLines").value);
+    const fewShotPatience = parseInt(document.querySelector("#fewShotPatience").value);
+    const fewShotBatchSize = parseInt(document.querySelector("#fewShotBatchSize").value);
+    const fewShotGradientAccumulation = parseInt(document.querySelector("#fewShotGradientAccumulation").value);
 
     if(!base_models_for_fine_tuning.includes(selectedModelFewShots)){
         few_shot_train_new_model_name = project_lookup_table["fine_tuned_model_name_mapping"][selectedModelFewShots];
@@ -560,6 +570,20 @@ const execute_backend_few_shot_train_promise = () => {
         });
     }
 
+    if(!(fewShotValidationEvery >= 1 && fewShotValidationEvery <= 20 && fewShotValidationLines >= 0 && fewShotPatience >= 0 && fewShotPatience <= 20)){
+        functionInitErrorWidget("Warning: please make sure to validate every 1 to 20 epochs, on 0 (all) or more lines, with an early stopping patience between 0 (off) and 20.");
+        return new Promise((resolve, reject) => { //return empty promise to keep the statechart going
+            resolve();
+        });
+    }
+
+    if(!(fewShotBatchSize >= 1 && fewShotBatchSize <= 32 && fewShotGradientAccumulation >= 1 && fewShotGradientAccumulation <= 16)){
+        functionInitErrorWidget("Warning: please make sure to set the batch size between 1 and 32, and the batches per update between 1 and 16.");
+        return new Promise((resolve, reject) => { //return empty promise to keep the statechart going
+            resolve();
+        });
+    }
+
     const execution_parameters_to_server = {
         "executingScript": "few_shot_train",
         "user_validation_flag": user_validation_flag,
@@ -571,6 +595,12 @@ const execute_backend_few_shot_train_promise = () => {
         "few_shot_train_new_model_name": few_shot_train_new_model_name,
         "few_shot_train_epochs": few_shot_train_epochs,
         "fewShotReadSpacesBool": 0,
+        "fewShotFrozenBackbone": fewShotFrozenBackbone,
+        "fewShotValidationEvery": fewShotValidationEvery,
+        "fewShotValidationLines": fewShotValidationLines,
+        "fewShotPatience": fewShotPatience,
+        "fewShotBatchSize": fewShotBatchSize,
+        "fewShotGradientAccumulation": fewShotGradientAccumulation,
     };
 
 
@@ -252,6 +252,28 @@ $send_to_frontend = json_encode($send_to_frontend);
                                     <label >No</label>   
                                 </div>
                             </div>
+                            <b class="radioHeader"> Only re-decode previous prediction (new threshold / spaces) </b>
+                            <div class="RadioWrapper">
+                                <div>
+                                    <input type="radio" name="fewShotRedecodeOnly" value="1">
+                                    <label >Yes</label>   
+                                </div>
+                                <div>
+                                    <input type="radio" name="fewShotRedecodeOnly" value="0" checked>
+                                    <label >No</label>   
+                                </div>
+                            </div>
+                            <b class="radioHeader"> Backend (ONNX Runtime: CPU servers only) </b>
+                            <div class="RadioWrapper">
+                                <div>
+                                    <input type="radio" name="fewShotBackend" value="pytorch" checked>
+                                    <label >PyTorch</label>   
+                                </div>
+                                <div>
+                                    <input type="radio" name="fewShotBackend" value="onnxruntime">
+                                    <label >ONNX Runtime</label>   
+                                </div>
+                            </div>
                             <div class="inputWrapper">
                                 <label for="numberOfShots">Number of shots (default 5):</label>
                                 <input id="numberOfShots" type="number" name="numberOfShots" value="5" max="5" min="1" step="1">
@@ -323,6 +345,37 @@ $send_to_frontend = json_encode($send_to_frontend);
                                 <label for="few_shot_train_epochs">Epochs (default 6):</label>
                                 <input id="few_shot_train_epochs" type="number" name="few_shot_train_epochs" value="6" max="20" min="1" step="1">
                             </div>
+                            <b class="radioHeader"> Train only the heads (frozen backbone, also on CPU) </b>
+                            <div class="RadioWrapper">
+                                <div>
+                                    <input type="radio" name="fewShotFrozenBackbone" value="1">
+                                    <label >Yes</label>   
+                                </div>
+                                <div>
+                                    <input type="radio" name="fewShotFrozenBackbone" value="0" checked>
+                                    <label >No</label>   
+                                </div>
+                            </div>
+                            <div class="inputWrapper">
+                                <label for="fewShotValidationEvery">Validate every N epochs (default 1):</label>
+                                <input id="fewShotValidationEvery" type="number" name="fewShotValidationEvery" value="1" max="20" min="1" step="1">
+                            </div>
+                            <div class="inputWrapper">
+                                <label for="fewShotValidationLines">Validation lines (0: all):</label>
+                                <input id="fewShotValidationLines" type="number" name="fewShotValidationLines" value="0" min="0" step="1">
+                            </div>
+                            <div class="inputWrapper">
+                                <label for="fewShotPatience">Early stopping after N epochs without improvement (0: off):</label>
+                                <input id="fewShotPatience" type="number" name="fewShotPatience" value="0" max="20" min="0" step="1">
+                            </div>
+                            <div class="inputWrapper">
+                                <label for="fewShotBatchSize">Batch size (default 3):</label>
+                                <input id="fewShotBatchSize" type="number" name="fewShotBatchSize" value="3" max="32" min="1" step="1">
+                            </div>
+                            <div class="inputWrapper">
+                                <label for="fewShotGradientAccumulation">Batches per update (default 1):</label>
+                                <input id="fewShotGradientAccumulation" type="number" name="fewShotGradientAccumulation" value="1" max="16" min="1" step="1">
+                            </div>
                             
                         </div>
                         <button id="execute_few_shot_train_button" class="stateButton"> execute </button>
@@ -79,6 +79,22 @@ try {
             $execution_parameters["fewShotReadSpacesBool"] = 0;
         }
 
+        if(isset($execution_parameters_from_frontend["fewShotRedecodeOnly"]) && $execution_parameters_from_frontend["fewShotRedecodeOnly"] === 1){
+            $execution_parameters["fewShotRedecodeOnly"] = 1;
+        }
+        else{
+            $execution_parameters["fewShotRedecodeOnly"] = 0;
+        }
+
+        $possible_backends = ["pytorch", "onnxruntime"];
+
+        if(isset($execution_parameters_from_frontend["fewShotBackend"]) && is_string($execution_parameters_from_frontend["fewShotBackend"]) && in_array($execution_parameters_from_frontend["fewShotBackend"], $possible_backends)){
+            $execution_parameters["fewShotBackend"] = $execution_parameters_from_frontend["fewShotBackend"];
+        }
+        else{
+            $execution_parameters["fewShotBackend"] = "pytorch";
+        }
+
         $execution_parameters["array_images"] = array_keys($bounding_boxes["documents"]);
 
         
@@ -129,6 +145,51 @@ try {
             $execution_parameters["fewShotReadSpacesBool"] = 0;
         }
 
+        // validation every N epochs (the last epoch is always validated), on a sample of N lines (0: all lines)
+        if(isset($execution_parameters_from_frontend["fewShotValidationEvery"]) && is_int($execution_parameters_from_frontend["fewShotValidationEvery"]) && $execution_parameters_from_frontend["fewShotValidationEvery"] >= 1 && $execution_parameters_from_frontend["fewShotValidationEvery"] <= 20){
+            $execution_parameters["fewShotValidationEvery"] = $execution_parameters_from_frontend["fewShotValidationEvery"];
+        }
+        else{
+            $execution_parameters["fewShotValidationEvery"] = 1;
+        }
+
+        if(isset($execution_parameters_from_frontend["fewShotValidationLines"]) && is_int($execution_parameters_from_frontend["fewShotValidationLines"]) && $execution_parameters_from_frontend["fewShotValidationLines"] >= 0){
+            $execution_parameters["fewShotValidationLines"] = $execution_parameters_from_frontend["fewShotValidationLines"];
+        }
+        else{
+            $execution_parameters["fewShotValidationLines"] = 0;
+        }
+
+        // early stopping after N epochs without improvement (0: all epochs are run)
+        if(isset($execution_parameters_from_frontend["fewShotPatience"]) && is_int($execution_parameters_from_frontend["fewShotPatience"]) && $execution_parameters_from_frontend["fewShotPatience"] >= 0 && $execution_parameters_from_frontend["fewShotPatience"] <= 20){
+            $execution_parameters["fewShotPatience"] = $execution_parameters_from_frontend["fewShotPatience"];
+        }
+        else{
+            $execution_parameters["fewShotPatience"] = 0;
+        }
+
+        // only the heads of the model are trained, on cached backbone features (also possible on CPU)
+        if(isset($execution_parameters_from_frontend["fewShotFrozenBackbone"]) && $execution_parameters_from_frontend["fewShotFrozenBackbone"] === 1){
+            $execution_parameters["fewShotFrozenBackbone"] = 1;
+        }
+        else{
+            $execution_parameters["fewShotFrozenBackbone"] = 0;
+        }
+
+        // batch size of the training and number of batches per optimizer step (the data loading is set per host in the wrapper)
+        $possible_integer_parameters = [
+            "fewShotBatchSize" => [1, 32, 3],
+            "fewShotGradientAccumulation" => [1, 16, 1],
+        ];
+        foreach($possible_integer_parameters as $parameter => list($minimum, $maximum, $default)){
+            if(isset($execution_parameters_from_frontend[$parameter]) && is_int($execution_parameters_from_frontend[$parameter]) && $execution_parameters_from_frontend[$parameter] >= $minimum && $execution_parameters_from_frontend[$parameter] <= $maximum){
+                $execution_parameters[$parameter] = $execution_parameters_from_frontend[$parameter];
+            }
+            else{
+                $execution_parameters[$parameter] = $default;
+            }
+        }
+
         $execution_parameters["array_images"] = array_keys($bounding_boxes["documents"]);
 
     }
@@ -202,6 +263,8 @@ try {
         $log_exec_parameters .= "\t\t Alphabet = " . $execution_parameters["selectedAlphabetFewShots"] . "\n";
         $log_exec_parameters .= "\t\t Model = " . $execution_parameters["selected_model_user_given_name"] . "\n";
         $log_exec_parameters .= "\t\t Read spaces = " . $fewShotReadSpacesBool_string . "\n";
+        $log_exec_parameters .= "\t\t Only re-decode = " . ($execution_parameters["fewShotRedecodeOnly"] ? "yes" : "no") . "\n";
+        $log_exec_parameters .= "\t\t Backend = " . $execution_parameters["fewShotBackend"] . "\n";
         
 
 
@@ -228,6 +291,11 @@ try {
         $log_exec_parameters .= "\t\t Fine tuned model = " . $execution_parameters["few_shot_train_new_model_name"] . "\n";
         $log_exec_parameters .= "\t\t Read spaces = " . $fewShotReadSpacesBool_string . "\n";
         $log_exec_parameters .= "\t\t Validation = " . $user_validation_flag_string . "\n";
+        $log_exec_parameters .= "\t\t Validation every = " . $execution_parameters["fewShotValidationEvery"] . " epochs\n";
+        $log_exec_parameters .= "\t\t Validation lines = " . ($execution_parameters["fewShotValidationLines"] ? $execution_parameters["fewShotValidationLines"] : "all") . "\n";
+        $log_exec_parameters .= "\t\t Early stopping patience = " . ($execution_parameters["fewShotPatience"] ? $execution_parameters["fewShotPatience"] . " epochs" : "off") . "\n";
+        $log_exec_parameters .= "\t\t Frozen backbone = " . ($execution_parameters["fewShotFrozenBackbone"] ? "yes" : "no") . "\n";
+        $log_exec_parameters .= "\t\t Batch size = " . $execution_parameters["fewShotBatchSize"] . " x " . $execution_parameters["fewShotGradientAccumulation"] . " accumulated\n";
         
 
         
@@ -297,7 +365,7 @@ try {
     $gpu_server_generated_transcription_path = "$gpu_server_folder_path/temp/$sessionID-generated_transcription.json";
     $gpu_server_working_dir = "$gpu_server_folder_path/temp";
 
-    $command = "$py_interpreter $gpu_server_folder_path/gpu_image_processing_wrapper.py --code $py_script --lookup_table $gpu_server_lookup_table_path";
+    $command = "$py_interpreter $gpu_server_folder_path/few_shot_client.py --code $py_script --lookup_table $gpu_server_lookup_table_path";
     $command .= " --parameters $gpu_server_parameters_path --success_flag $gpu_server_success_flag_path --boxes $gpu_server_bounding_boxes_path --transcription $gpu_server_transcription_path";
     $command .= " --generated_transcription $gpu_server_generated_transcription_path --sessionID $sessionID --working_dir $gpu_server_working_dir --suffix $suffix 2>&1";
 
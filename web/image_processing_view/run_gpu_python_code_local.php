@@ -141,7 +141,7 @@ try {
     $gpu_server_generated_transcription_path = "$saveDirGPU/generated_transcription.json";
 
     // construct and execute the command
-    $command = "$FEW_SHOT_TRAIN_PYTHON_INTERPRETER $gpu_server_folder_path/gpu_image_processing_wrapper.py --code $py_script --lookup_table $gpu_server_lookup_table_path";
+    $command = "$FEW_SHOT_TRAIN_PYTHON_INTERPRETER $gpu_server_folder_path/few_shot_client.py --code $py_script --lookup_table $gpu_server_lookup_table_path";
     $command .= " --parameters $gpu_server_parameters_path --success_flag $gpu_server_success_flag_path --boxes $gpu_server_bounding_boxes_path --transcription $gpu_server_transcription_path";
     $command .= " --generated_transcription $gpu_server_generated_transcription_path --working_dir $saveDirGPU --sessionID $sessionID --suffix $suffix 2>&1";
 